@@ -0,0 +1,43 @@
+from timeit import default_timer
+
+from django.db import models
+from chargeable.models import Chargeable
+
+
+class BenchCustomer(models.Model):
+    stripe_token = models.CharField(max_length=50, null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+
+
+class BenchOrder(Chargeable):
+    customer = models.ForeignKey(BenchCustomer, on_delete=models.CASCADE)
+    amount = models.IntegerField(default=1000)
+
+    payer_field = 'customer'
+
+    # Durations of every charge() and refund() call, collected by benchmarks.run
+    durations = []
+
+    @property
+    def payer(self):
+        return self.customer
+
+    def _validate_for_charge(self, **kwargs):
+        pass
+
+    def get_charge_amount(self):
+        return self.amount
+
+    def charge(self, **kwargs):
+        start = default_timer()
+        try:
+            return super(BenchOrder, self).charge(**kwargs)
+        finally:
+            self.durations.append(default_timer() - start)
+
+    def refund(self, amount=None, reason=None, **kwargs):
+        start = default_timer()
+        try:
+            return super(BenchOrder, self).refund(amount=amount, reason=reason, **kwargs)
+        finally:
+            self.durations.append(default_timer() - start)
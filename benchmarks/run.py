@@ -0,0 +1,144 @@
+"""
+Benchmarks charge and refund pipelines against a local stub Stripe server.
+
+    python -m benchmarks.run --objects 500 --latency 0.05 --concurrency 8 --output results.jsonl
+
+Every scenario prints one JSON line with throughput, latency percentiles and DB/cache calls per operation.
+Database and cache are configured with BENCH_* environment variables, see benchmarks/settings.py.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from timeit import default_timer
+
+
+class CallCounter(object):
+    """Counts calls of the given methods across all threads by wrapping them on their classes."""
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.count = 0
+        self._lock = threading.Lock()
+        self._originals = []
+
+    def __enter__(self):
+        for cls, names in self.targets:
+            for name in names:
+                original = getattr(cls, name)
+                self._originals.append((cls, name, original))
+                setattr(cls, name, self._wrap(original))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for cls, name, original in reversed(self._originals):
+            setattr(cls, name, original)
+        self._originals = []
+
+    def _wrap(self, method):
+        counter = self
+
+        def wrapper(*args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def create_orders(count):
+    from benchmarks.bench_app.models import BenchCustomer, BenchOrder
+
+    customer = BenchCustomer.objects.create(stripe_token='cus_benchmark')
+    BenchOrder.objects.bulk_create([BenchOrder(customer=customer) for _ in range(count)])
+    return list(BenchOrder.objects.filter(customer=customer).select_related('customer'))
+
+
+def measure(name, operation, count, options):
+    from django.core.cache import caches
+    from django.db.backends.utils import CursorWrapper
+    from benchmarks.bench_app.models import BenchOrder
+
+    cache_class = type(caches['default'])
+    cache_methods = [name for name in ('add', 'get', 'set', 'delete', 'delete_many', 'get_many', 'set_many', 'incr')
+                     if hasattr(cache_class, name)]
+
+    del BenchOrder.durations[:]
+    with CallCounter([(CursorWrapper, ['execute', 'executemany'])]) as queries, \
+            CallCounter([(cache_class, cache_methods)]) as cache_ops:
+        start = default_timer()
+        operation()
+        elapsed = default_timer() - start
+
+    durations = BenchOrder.durations
+    return {
+        'scenario': name,
+        'objects': count,
+        'concurrency': options.concurrency,
+        'gateway_latency': options.latency,
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': round(count / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3) if durations else None,
+        'p95_ms': round(percentile(durations, 95) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 99) * 1000, 3) if durations else None,
+        'queries_per_op': round(float(queries.count) / count, 2),
+        'cache_ops_per_op': round(float(cache_ops.count) / count, 2),
+    }
+
+
+def run_scenarios(options):
+    from benchmarks.bench_app.models import BenchOrder
+
+    orders = create_orders(options.objects)
+    yield measure('charge', lambda: [order.charge() for order in orders], len(orders), options)
+    yield measure('refund', lambda: [order.refund() for order in orders], len(orders), options)
+
+    orders = create_orders(options.objects)
+    queryset = BenchOrder.objects.filter(pk__in=[order.pk for order in orders]).select_related('customer')
+    yield measure('charge_many',
+                  lambda: BenchOrder.objects.charge_many(queryset, concurrency=options.concurrency),
+                  len(orders), options)
+    yield measure('refund_many',
+                  lambda: BenchOrder.objects.refund_many(queryset, concurrency=options.concurrency),
+                  len(orders), options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=200, help='Objects charged per scenario.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Stub Stripe response delay in seconds.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Threads used by bulk scenarios.')
+    parser.add_argument('--output', help='Append results to this JSON lines file as well.')
+    options = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+    import stripe
+    from django.core.management import call_command
+    from benchmarks.stub_stripe import StubStripeServer
+
+    django.setup()
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    server = StubStripeServer(latency=options.latency).start()
+    stripe.api_base = server.url
+    try:
+        for result in run_scenarios(options):
+            line = json.dumps(result, sort_keys=True)
+            sys.stdout.write(line + '\n')
+            if options.output:
+                with open(options.output, 'a') as output:
+                    output.write(line + '\n')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import os
+
+
+SECRET_KEY = 'chargeable-benchmarks'
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'chargeable',
+    'benchmarks.bench_app',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': os.environ.get('BENCH_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('BENCH_DB_NAME', 'chargeable_bench.sqlite3'),
+        'USER': os.environ.get('BENCH_DB_USER', ''),
+        'PASSWORD': os.environ.get('BENCH_DB_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_DB_HOST', ''),
+        'PORT': os.environ.get('BENCH_DB_PORT', ''),
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('BENCH_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('BENCH_CACHE_LOCATION', ''),
+    }
+}
+
+STRIPE_API_KEY = 'sk_test_benchmark'
+USE_TZ = False
@@ -0,0 +1,83 @@
+"""Minimal Stripe API stand-in answering charge and refund requests after a configurable delay."""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+
+def charge_object(charge_id, amount, refunded=False):
+    return {
+        'id': charge_id,
+        'object': 'charge',
+        'amount': amount,
+        'amount_refunded': amount if refunded else 0,
+        'captured': True,
+        'currency': 'usd',
+        'refunded': refunded,
+        'status': 'succeeded',
+    }
+
+
+class StubStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        return dict((key, values[0]) for key, values in parse_qs(body).items())
+
+    def respond(self, data):
+        time.sleep(self.server.latency)
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # GET /v1/charges/<id>
+        charge_id = self.path.rstrip('/').split('/')[-1]
+        self.respond(charge_object(charge_id, 1000))
+
+    def do_POST(self):
+        params = self.params()
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts == ['v1', 'charges']:
+            self.respond(charge_object('ch_%s' % uuid.uuid4().hex[:24], int(params.get('amount', 0))))
+        elif parts[:2] == ['v1', 'charges'] and parts[-1] == 'refund':
+            self.respond(charge_object(parts[2], 1000, refunded='amount' not in params))
+        elif parts == ['v1', 'refunds']:
+            amount = int(params['amount']) if 'amount' in params else 1000
+            self.respond({
+                'id': 're_%s' % uuid.uuid4().hex[:24],
+                'object': 'refund',
+                'amount': amount,
+                'charge': charge_object(params.get('charge'), 1000, refunded='amount' not in params),
+            })
+        else:
+            self.send_error(404)
+
+
+class StubStripeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubStripeHandler)
+        self.latency = latency
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
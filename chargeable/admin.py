@@ -1,7 +1,73 @@
-from django.conf.urls import patterns, url
+import logging
+import time
+import uuid
+
 from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.cache import caches
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.http import Http404
 from django.shortcuts import render
+from django.template.response import TemplateResponse
+from django.urls import re_path, reverse
+from django.utils.html import format_html
+from chargeable import app_settings
+from chargeable.choices import *
 from chargeable.forms import ChargeableRefundForm
+from chargeable.scheduler import get_scheduler
+from chargeable.utils import chunked, close_connections, get_executor
+
+
+logger = logging.getLogger('chargeable')
+
+
+def _job_key(job_id):
+    return 'chargeable_admin_job_%s' % job_id
+
+
+def get_job_progress(job_id):
+    return caches[app_settings.CHARGEABLE_LOCK_CACHE].get(_job_key(job_id))
+
+
+def is_job_lost(progress, now=None):
+    """
+    Whether an unfinished job stopped making progress, e.g. because the web process running it was restarted:
+    it is lost once a batch takes longer than the locks of a batch last.
+    """
+    return not progress['finished'] and (now or time.time()) - progress['updated'] > progress['lost_after']
+
+
+def run_job(job_id, func, queryset, batch_size=None):
+    """
+    Call bulk `func` (e.g. `charge_many`) for every batch of `queryset`,
+    storing number of processed objects and outcome counts in the cache after each batch.
+    """
+    cache = caches[app_settings.CHARGEABLE_LOCK_CACHE]
+    key, timeout = _job_key(job_id), app_settings.CHARGEABLE_ADMIN_JOB_TIMEOUT
+    progress = cache.get(key) or new_job_progress(None, timeout)
+    try:
+        objects = queryset.iterator() if hasattr(queryset, 'iterator') else queryset
+        for batch in chunked(objects, batch_size or app_settings.CHARGEABLE_BULK_BATCH_SIZE):
+            for outcome, objs in func(batch).items():
+                progress['outcomes'][outcome] = progress['outcomes'].get(outcome, 0) + len(objs)
+            progress['done'] += len(batch)
+            progress['updated'] = time.time()
+            cache.set(key, progress, timeout)
+    except Exception:
+        logger.exception('Admin job %s failed', job_id)
+        progress['error'] = True
+    finally:
+        progress['finished'] = True
+        cache.set(key, progress, timeout)
+        close_connections()
+    return progress
+
+
+def new_job_progress(total, lost_after):
+    now = time.time()
+    return {'total': total, 'done': 0, 'outcomes': {}, 'finished': False, 'error': False,
+            'started': now, 'updated': now, 'lost_after': lost_after}
 
 
 class ChargeableAdminRefundMixin(object):
@@ -27,15 +93,101 @@ class ChargeableAdminRefundMixin(object):
             return render(request, template_name, context={'form': form, 'is_popup': 1})
 
 
-class ChargeableAdmin(admin.ModelAdmin, ChargeableAdminRefundMixin):
+class ChargeableAdminBulkMixin(object):
+    """
+    Bulk actions handing the selection over to `charge_many`, `refund_many` and `retry_many`
+    running on the shared executor, progress is kept in the cache and shown on a page of its own.
+    """
+    actions = ['charge_selected', 'refund_selected', 'retry_failed']
+
+    def start_job(self, request, queryset, func, verb):
+        job_id = uuid.uuid4().hex
+        total = queryset.count()
+        lost_after = self.model._default_manager.batch_lock_time(
+            app_settings.CHARGEABLE_BULK_BATCH_SIZE, app_settings.CHARGEABLE_BULK_CONCURRENCY, get_scheduler())
+        caches[app_settings.CHARGEABLE_LOCK_CACHE].set(
+            _job_key(job_id),
+            new_job_progress(total, lost_after),
+            app_settings.CHARGEABLE_ADMIN_JOB_TIMEOUT
+        )
+        get_executor().submit(run_job, job_id, func, queryset)
+        info = self.model._meta.app_label, self.model._meta.model_name
+        url = reverse('admin:%s_%s_chargeable_job' % info, args=(job_id,))
+        self.message_user(request, format_html('{} {} objects in the background, <a href="{}">see progress</a>.',
+                                               verb, total, url), messages.INFO)
+
+    def charge_selected(self, request, queryset):
+        self.start_job(request, queryset.filter(charge_status=NOT_PAID), self.model._default_manager.charge_many,
+                       'Charging')
+    charge_selected.short_description = 'Charge selected %(verbose_name_plural)s'
+    charge_selected.allowed_permissions = ('change',)
+
+    def confirm_job(self, request, queryset, action, verb):
+        """Intermediate page asking to confirm `action` on `queryset`, like the one of delete_selected."""
+        totals = queryset.aggregate(count=Count('pk'), amount=Coalesce(Sum('charge_amount'), 0))
+        context = dict(self.admin_site.each_context(request),
+                       title='Are you sure?',
+                       opts=self.model._meta,
+                       action=action,
+                       verb=verb,
+                       count=totals['count'],
+                       amount=round(totals['amount'] / 100.0, 2),
+                       pks=queryset.values_list('pk', flat=True),
+                       action_checkbox_name=helpers.ACTION_CHECKBOX_NAME)
+        return TemplateResponse(request, 'admin/chargeable/job_confirmation.html', context)
+
+    def refund_selected(self, request, queryset):
+        queryset = queryset.filter(charge_status__in=[PAID, PARTIALLY_REFUNDED])
+        # refunds can not be undone, the job starts only once the confirmation page is posted
+        if request.POST.get('post') != 'yes':
+            return self.confirm_job(request, queryset, 'refund_selected', 'Refund')
+        self.start_job(request, queryset, self.model._default_manager.refund_many, 'Refunding')
+    refund_selected.short_description = 'Refund selected %(verbose_name_plural)s'
+    refund_selected.allowed_permissions = ('change',)
+
+    def retry_failed(self, request, queryset):
+        self.start_job(request, queryset.filter(charge_status=FAILED), self.model._default_manager.retry_many,
+                       'Retrying')
+    retry_failed.short_description = 'Retry failed charges of selected %(verbose_name_plural)s'
+    retry_failed.allowed_permissions = ('change',)
+
+    def job_progress(self, request, job_id, **kwargs):
+        progress = get_job_progress(job_id)
+        if progress is None:
+            raise Http404('Unknown job %s' % job_id)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, progress=progress,
+                       lost=is_job_lost(progress), outcomes=sorted(progress['outcomes'].items()))
+        return render(request, 'admin/chargeable/job_progress.html', context=context)
+
+
+class ChargeableAdmin(ChargeableAdminBulkMixin, admin.ModelAdmin, ChargeableAdminRefundMixin):
+    change_list_template = 'admin/chargeable/change_list.html'
 
     def get_urls(self):
         info = self.model._meta.app_label, self.model._meta.model_name
 
-        urls = patterns('',
-                        (url(r'^(\d+)/refund/$',
-                             self.admin_site.admin_view(self.do_refund),
-                             name='%s_%s_refund' % info)
-                         ),
-                        )
-        return urls + super(ChargeableAdmin, self).get_urls()
\ No newline at end of file
+        urls = [
+            re_path(r'^(.+)/refund/$',
+                self.admin_site.admin_view(self.do_refund),
+                name='%s_%s_refund' % info),
+            re_path(r'^chargeable-jobs/(\w+)/$',
+                self.admin_site.admin_view(self.job_progress),
+                name='%s_%s_chargeable_job' % info),
+        ]
+        return urls + super(ChargeableAdmin, self).get_urls()
+
+    def get_charge_totals(self, queryset):
+        """Number of objects and sum of charge_amount per charge_status of `queryset`, with one aggregate query."""
+        labels = dict(CHARGEABLE_STATUS_CHOICES)
+        rows = queryset.order_by().values('charge_status')\
+            .annotate(count=Count('pk'), amount=Coalesce(Sum('charge_amount'), 0))\
+            .order_by('charge_status')
+        return [dict(row, label=labels.get(row['charge_status'], row['charge_status'])) for row in rows]
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(ChargeableAdmin, self).changelist_view(request, extra_context)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            # totals of all filtered objects, not only of the current page
+            context['charge_totals'] = self.get_charge_totals(context['cl'].queryset)
+        return response
@@ -3,4 +3,48 @@ from django.conf import settings
 
 CHARGEABLE_STRIPE_MINIMUM_CHARGE_AMOUNT = getattr(settings, 'CHARGEABLE_STRIPE_MINIMUM_CHARGE_AMOUNT', 50)
 CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT = getattr(settings, 'CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT', 50000)
-CHARGEABLE_CHARGE_LOCK_TIME = getattr(settings, 'CHARGEABLE_CHARGE_LOCK_TIME', 60)
\ No newline at end of file
+CHARGEABLE_CHARGE_LOCK_TIME = getattr(settings, 'CHARGEABLE_CHARGE_LOCK_TIME', 60)
+CHARGEABLE_LOCK_BACKEND = getattr(settings, 'CHARGEABLE_LOCK_BACKEND', 'chargeable.locks.CacheLockBackend')
+CHARGEABLE_LOCK_CACHE = getattr(settings, 'CHARGEABLE_LOCK_CACHE', 'default')
+CHARGEABLE_LOCK_REDIS_URL = getattr(settings, 'CHARGEABLE_LOCK_REDIS_URL', 'redis://localhost:6379/0')
+CHARGEABLE_LOCK_DATABASE = getattr(settings, 'CHARGEABLE_LOCK_DATABASE', 'default')
+CHARGEABLE_BULK_CONCURRENCY = getattr(settings, 'CHARGEABLE_BULK_CONCURRENCY', 8)
+CHARGEABLE_BULK_BATCH_SIZE = getattr(settings, 'CHARGEABLE_BULK_BATCH_SIZE', 500)
+CHARGEABLE_BULK_UPDATE_BATCH_SIZE = getattr(settings, 'CHARGEABLE_BULK_UPDATE_BATCH_SIZE', 500)
+CHARGEABLE_ASYNC_MAX_WORKERS = getattr(settings, 'CHARGEABLE_ASYNC_MAX_WORKERS', 100)
+
+CHARGEABLE_GATEWAY = getattr(settings, 'CHARGEABLE_GATEWAY', 'chargeable.gateways.StripeGateway')
+CHARGEABLE_GATEWAY_TIMEOUT = getattr(settings, 'CHARGEABLE_GATEWAY_TIMEOUT', 30)
+CHARGEABLE_GATEWAY_POOL_SIZE = getattr(settings, 'CHARGEABLE_GATEWAY_POOL_SIZE', 10)
+CHARGEABLE_GATEWAY_RATE_LIMIT = getattr(settings, 'CHARGEABLE_GATEWAY_RATE_LIMIT', None)
+CHARGEABLE_GATEWAY_RATE_LIMIT_SHARED = getattr(settings, 'CHARGEABLE_GATEWAY_RATE_LIMIT_SHARED', False)
+CHARGEABLE_GATEWAY_RETRIES = getattr(settings, 'CHARGEABLE_GATEWAY_RETRIES', 5)
+CHARGEABLE_GATEWAY_BACKOFF = getattr(settings, 'CHARGEABLE_GATEWAY_BACKOFF', 0.5)
+CHARGEABLE_GATEWAY_MAX_BACKOFF = getattr(settings, 'CHARGEABLE_GATEWAY_MAX_BACKOFF', 30)
+CHARGEABLE_SIMULATED_LATENCY = getattr(settings, 'CHARGEABLE_SIMULATED_LATENCY', 0)
+CHARGEABLE_SIMULATED_FAILURE_RATE = getattr(settings, 'CHARGEABLE_SIMULATED_FAILURE_RATE', 0)
+CHARGEABLE_WORKER_BATCH_SIZE = getattr(settings, 'CHARGEABLE_WORKER_BATCH_SIZE', 100)
+CHARGEABLE_WORKER_IDLE_SLEEP = getattr(settings, 'CHARGEABLE_WORKER_IDLE_SLEEP', 5)
+CHARGEABLE_WORKER_CLAIM_TIME = getattr(settings, 'CHARGEABLE_WORKER_CLAIM_TIME', 60 * 10)
+CHARGEABLE_METRICS_BACKEND = getattr(settings, 'CHARGEABLE_METRICS_BACKEND', 'chargeable.metrics.NullMetrics')
+CHARGEABLE_METRICS_PREFIX = getattr(settings, 'CHARGEABLE_METRICS_PREFIX', 'chargeable')
+CHARGEABLE_METRICS_STATSD_HOST = getattr(settings, 'CHARGEABLE_METRICS_STATSD_HOST', 'localhost')
+CHARGEABLE_METRICS_STATSD_PORT = getattr(settings, 'CHARGEABLE_METRICS_STATSD_PORT', 8125)
+CHARGEABLE_WEBHOOK_BATCH_SIZE = getattr(settings, 'CHARGEABLE_WEBHOOK_BATCH_SIZE', 100)
+CHARGEABLE_WEBHOOK_MAX_DELAY = getattr(settings, 'CHARGEABLE_WEBHOOK_MAX_DELAY', 2)
+CHARGEABLE_WEBHOOK_SECRET = getattr(settings, 'CHARGEABLE_WEBHOOK_SECRET', None)
+CHARGEABLE_ROLLUP = getattr(settings, 'CHARGEABLE_ROLLUP', False)
+CHARGEABLE_ATTEMPT_LOG = getattr(settings, 'CHARGEABLE_ATTEMPT_LOG', False)
+CHARGEABLE_ATTEMPT_LOG_BATCH_SIZE = getattr(settings, 'CHARGEABLE_ATTEMPT_LOG_BATCH_SIZE', 100)
+CHARGEABLE_ATTEMPT_LOG_MAX_DELAY = getattr(settings, 'CHARGEABLE_ATTEMPT_LOG_MAX_DELAY', 2)
+CHARGEABLE_CIRCUIT_BREAKER = getattr(settings, 'CHARGEABLE_CIRCUIT_BREAKER', False)
+CHARGEABLE_BREAKER_ERROR_RATE = getattr(settings, 'CHARGEABLE_BREAKER_ERROR_RATE', 0.5)
+CHARGEABLE_BREAKER_SLOW_CALL = getattr(settings, 'CHARGEABLE_BREAKER_SLOW_CALL', None)
+CHARGEABLE_BREAKER_MIN_CALLS = getattr(settings, 'CHARGEABLE_BREAKER_MIN_CALLS', 20)
+CHARGEABLE_BREAKER_WINDOW = getattr(settings, 'CHARGEABLE_BREAKER_WINDOW', 30)
+CHARGEABLE_BREAKER_COOLDOWN = getattr(settings, 'CHARGEABLE_BREAKER_COOLDOWN', 30)
+# Seconds from a failed charge to its next retry, one entry per retry
+CHARGEABLE_RETRY_SCHEDULE = getattr(settings, 'CHARGEABLE_RETRY_SCHEDULE', [60 * 60 * 24, 60 * 60 * 24 * 3, 60 * 60 * 24 * 7])
+# Authorizations older than this are released, card authorizations expire after 7 days
+CHARGEABLE_AUTHORIZATION_MAX_AGE = getattr(settings, 'CHARGEABLE_AUTHORIZATION_MAX_AGE', 60 * 60 * 24 * 6)
+CHARGEABLE_ADMIN_JOB_TIMEOUT = getattr(settings, 'CHARGEABLE_ADMIN_JOB_TIMEOUT', 60 * 60 * 24)
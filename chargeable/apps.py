@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class ChargeableConfig(AppConfig):
+    name = 'chargeable'
+    # migrations of the package create AutoField ids whatever DEFAULT_AUTO_FIELD of the project is
+    default_auto_field = 'django.db.models.AutoField'
@@ -0,0 +1,119 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from chargeable import app_settings, rollup
+from chargeable.metrics import get_metrics
+from chargeable.utils import close_connections
+
+
+logger = logging.getLogger('chargeable')
+
+_attempt_log = None
+_attempt_log_lock = threading.Lock()
+
+
+def get_attempt_log():
+    """Return process wide AttemptLog, flushed when the process exits."""
+    global _attempt_log
+    with _attempt_log_lock:
+        if _attempt_log is None:
+            _attempt_log = AttemptLog()
+            atexit.register(_attempt_log.flush)
+    return _attempt_log
+
+
+class OutcomeBuffer(object):
+    """
+    Collects charge outcomes and writes them with one `bulk_update` per model and set of fields.
+    Callbacks registered with an object run after it has been written, their exceptions are logged.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or app_settings.CHARGEABLE_BULK_UPDATE_BATCH_SIZE
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, obj, fields, callback=None):
+        with self._lock:
+            self._pending.append((obj, fields, callback))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        groups = OrderedDict()
+        for obj, fields, _ in pending:
+            if fields:
+                groups.setdefault((type(obj), tuple(fields)), []).append(obj)
+        for (model, fields), objs in groups.items():
+            with get_metrics().timer('bulk.flush', model=model.__name__):
+                rollup.write(model, objs,
+                             lambda: model._default_manager.bulk_update(objs, fields, batch_size=self.batch_size))
+
+        for obj, _, callback in pending:
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception:
+                # the outcome is already written, a failing hook must not lose the rest of the batch
+                logger.exception('Hook failed after writing %s %s', obj.__class__.__name__, obj.pk)
+
+
+class AttemptLog(object):
+    """
+    Collects ChargeAttempt rows and inserts them with one `bulk_create` per CHARGEABLE_ATTEMPT_LOG_BATCH_SIZE rows
+    or after CHARGEABLE_ATTEMPT_LOG_MAX_DELAY seconds, whichever comes first. Bulk operations flush it per batch.
+    Rows are kept in process memory until written, a failed insert is logged and does not fail the charge.
+    """
+
+    def __init__(self, batch_size=None, max_delay=None):
+        self.batch_size = batch_size or app_settings.CHARGEABLE_ATTEMPT_LOG_BATCH_SIZE
+        self.max_delay = app_settings.CHARGEABLE_ATTEMPT_LOG_MAX_DELAY if max_delay is None else max_delay
+        self._lock = threading.Lock()
+        self._attempts = []
+        self._timer = None
+
+    def add(self, obj, operation, amount=None, error=None, duration=None):
+        from chargeable.models import ChargeAttempt
+
+        attempt = ChargeAttempt(model=obj._meta.label, object_id=str(obj.pk), operation=operation,
+                                charge_status=obj.charge_status, amount=amount, charge_id=obj.charge_id,
+                                error=error[:255] if error else None, duration=duration)
+        with self._lock:
+            self._attempts.append(attempt)
+            full = len(self._attempts) >= self.batch_size
+            if not full and self._timer is None and self.max_delay:
+                self._timer = threading.Timer(self.max_delay, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+        if full or not self.max_delay:
+            self.flush()
+
+    def flush(self):
+        from chargeable.models import ChargeAttempt
+
+        with self._lock:
+            attempts, self._attempts = self._attempts, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not attempts:
+            return
+        try:
+            ChargeAttempt.objects.bulk_create(attempts, batch_size=self.batch_size)
+        except Exception:
+            logger.exception('Failed to write %s charge attempts', len(attempts))
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            close_connections()
@@ -1,17 +1,21 @@
 NOT_PAID = 0
+AUTHORIZED = 5
 PAID = 10
 FAILED = 20
 REFUNDED = 30
 PARTIALLY_REFUNDED = 31
 VALIDATION_FAILED = 40
+DISPUTED = 50
 
 CHARGEABLE_STATUS_CHOICES = (
     (NOT_PAID, 'Not paid'),
+    (AUTHORIZED, 'Authorized'),
     (PAID, 'Paid'),
     (FAILED, 'Failed'),
     (REFUNDED, 'Refunded'),
     (PARTIALLY_REFUNDED, 'Partially refunded'),
-    (VALIDATION_FAILED, 'Validation Failed')
+    (VALIDATION_FAILED, 'Validation Failed'),
+    (DISPUTED, 'Disputed'),
 )
 
 
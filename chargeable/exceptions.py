@@ -1,2 +1,19 @@
+from stripe.error import StripeError
+
+
 class ValidationError(Exception):
     pass
+
+
+def error_message(e):
+    """Message of StripeError or ValidationError `e` fit to be shown to a user, without Stripe request id."""
+    return getattr(e, 'user_message', None) or str(e)
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+class CircuitOpenError(StripeError):
+    """Gateway call was not made because the circuit breaker is open."""
+    pass
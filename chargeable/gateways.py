@@ -0,0 +1,143 @@
+import random
+import threading
+import time
+import uuid
+
+import stripe
+from django.conf import settings
+from django.utils.module_loading import import_string
+from stripe.error import CardError
+from chargeable import app_settings
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """Return process wide gateway instance configured by CHARGEABLE_GATEWAY."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = import_string(app_settings.CHARGEABLE_GATEWAY)()
+    return _gateway
+
+
+class BaseGateway(object):
+
+    def charge(self, amount, customer, description, currency='usd', idempotency_key=None, capture=True):
+        """
+        Must return charge object with `id` and `amount` attributes. Raise StripeError on failure.
+        Calls repeated with the same `idempotency_key` must not charge twice.
+        With `capture=False` the amount must only be authorized, see `capture()`.
+        """
+        raise NotImplementedError
+
+    def capture(self, charge_id, amount=None, idempotency_key=None):
+        """Must capture `amount` (all by default) of an authorized charge and return the charge object."""
+        raise NotImplementedError
+
+    def release(self, charge_id, idempotency_key=None):
+        """Cancel authorization of a charge that was not captured."""
+        return self.refund(charge_id, idempotency_key=idempotency_key)
+
+    def refund(self, charge_id, amount=None, reason=None, idempotency_key=None):
+        """Must return refunded charge object with `refunded` attribute. Raise StripeError on failure."""
+        raise NotImplementedError
+
+    def list_charges(self):
+        """Must iterate over all charges as dicts with id, amount, status, refunded, amount_refunded, disputed."""
+        raise NotImplementedError
+
+
+class StripeGateway(BaseGateway):
+    """
+    Talks to Stripe through one keep-alive HTTP session shared by all threads of the process.
+    API key is passed with every request instead of being set on the stripe module.
+    """
+
+    def __init__(self, api_key=None, timeout=None, pool_size=None):
+        import requests
+
+        self._api_key = api_key
+        session = requests.Session()
+        pool_size = pool_size or app_settings.CHARGEABLE_GATEWAY_POOL_SIZE
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        stripe.default_http_client = stripe.http_client.RequestsClient(
+            timeout=timeout or app_settings.CHARGEABLE_GATEWAY_TIMEOUT,
+            session=session
+        )
+
+    @property
+    def api_key(self):
+        return self._api_key or settings.STRIPE_API_KEY
+
+    def charge(self, amount, customer, description, currency='usd', idempotency_key=None, capture=True):
+        return stripe.Charge.create(amount=amount,
+                                    customer=customer,
+                                    currency=currency,
+                                    description=description,
+                                    capture=capture,
+                                    api_key=self.api_key,
+                                    idempotency_key=idempotency_key)
+
+    def capture(self, charge_id, amount=None, idempotency_key=None):
+        # Capture request only, the charge is not fetched first
+        charge = stripe.Charge.construct_from({'id': charge_id}, self.api_key)
+        return charge.capture(amount=amount, idempotency_key=idempotency_key)
+
+    def refund(self, charge_id, amount=None, reason=None, idempotency_key=None):
+        # One request: refund is created and the updated charge comes back expanded in the response
+        refund = stripe.Refund.create(charge=charge_id,
+                                      amount=amount,
+                                      reason=reason,
+                                      expand=['charge'],
+                                      api_key=self.api_key,
+                                      idempotency_key=idempotency_key)
+        return refund.charge
+
+    def list_charges(self):
+        return stripe.Charge.auto_paging_iter(limit=100, api_key=self.api_key)
+
+
+class SimulatedCharge(object):
+
+    def __init__(self, amount, refunded=False):
+        self.id = 'ch_sim_%s' % uuid.uuid4().hex[:20]
+        self.amount = amount
+        self.refunded = refunded
+
+
+class SimulatedGateway(BaseGateway):
+    """
+    In-process gateway for load tests, never touches the network.
+    Every call sleeps CHARGEABLE_SIMULATED_LATENCY seconds and fails with CHARGEABLE_SIMULATED_FAILURE_RATE probability.
+    """
+
+    def __init__(self, latency=None, failure_rate=None):
+        self.latency = app_settings.CHARGEABLE_SIMULATED_LATENCY if latency is None else latency
+        self.failure_rate = app_settings.CHARGEABLE_SIMULATED_FAILURE_RATE if failure_rate is None else failure_rate
+
+    def _simulate(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise CardError('Simulated card decline', None, 'card_declined')
+
+    def charge(self, amount, customer, description, currency='usd', idempotency_key=None, capture=True):
+        self._simulate()
+        return SimulatedCharge(amount)
+
+    def capture(self, charge_id, amount=None, idempotency_key=None):
+        self._simulate()
+        charge = SimulatedCharge(amount)
+        charge.id = charge_id
+        return charge
+
+    def refund(self, charge_id, amount=None, reason=None, idempotency_key=None):
+        self._simulate()
+        charge = SimulatedCharge(amount, refunded=amount is None)
+        charge.id = charge_id
+        return charge
@@ -0,0 +1,132 @@
+import hashlib
+import struct
+import threading
+import uuid
+
+from django.core.cache import caches
+from django.db import connections
+from django.utils.module_loading import import_string
+from chargeable import app_settings
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_lock_backend():
+    """Return process wide lock backend configured by CHARGEABLE_LOCK_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(app_settings.CHARGEABLE_LOCK_BACKEND)()
+    return _backend
+
+
+class BaseLockBackend(object):
+
+    def acquire(self, key, timeout=None):
+        return self.acquire_many([key], timeout)[0]
+
+    def release(self, key):
+        self.release_many([key])
+
+    def acquire_many(self, keys, timeout=None):
+        """
+        Must try to lock every key and return list of booleans, True for acquired ones.
+        Expiring locks expire after `timeout` seconds, the backend default when None.
+        """
+        raise NotImplementedError
+
+    def release_many(self, keys):
+        raise NotImplementedError
+
+
+class CacheLockBackend(BaseLockBackend):
+    """
+    Locks with `cache.add`, expiring after CHARGEABLE_CHARGE_LOCK_TIME.
+    Django cache API has no batched add, so only release is batched.
+    """
+
+    def __init__(self, alias=None, timeout=None):
+        self.cache = caches[alias or app_settings.CHARGEABLE_LOCK_CACHE]
+        self.timeout = timeout or app_settings.CHARGEABLE_CHARGE_LOCK_TIME
+
+    def acquire(self, key, timeout=None):
+        return self.cache.add(key, 1, timeout or self.timeout)
+
+    def release(self, key):
+        self.cache.delete(key)
+
+    def acquire_many(self, keys, timeout=None):
+        return [self.acquire(key, timeout) for key in keys]
+
+    def release_many(self, keys):
+        if keys:
+            self.cache.delete_many(keys)
+
+
+class RedisLockBackend(BaseLockBackend):
+    """
+    Locks with SET NX EX, a whole batch is acquired or released with one pipeline.
+    Only locks set by this process are released.
+    """
+
+    release_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, url=None, timeout=None):
+        import redis
+
+        self.client = redis.StrictRedis.from_url(url or app_settings.CHARGEABLE_LOCK_REDIS_URL)
+        self.timeout = timeout or app_settings.CHARGEABLE_CHARGE_LOCK_TIME
+        self.token = uuid.uuid4().hex
+        self.release_lock = self.client.register_script(self.release_script)
+
+    def acquire_many(self, keys, timeout=None):
+        if not keys:
+            return []
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.set(key, self.token, nx=True, ex=timeout or self.timeout)
+        return [bool(result) for result in pipeline.execute()]
+
+    def release_many(self, keys):
+        if not keys:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            self.release_lock(keys=[key], args=[self.token], client=pipeline)
+        pipeline.execute()
+
+
+class PostgresAdvisoryLockBackend(BaseLockBackend):
+    """
+    Session level Postgres advisory locks, a whole batch is acquired or released with one query.
+    Locks belong to the DB connection of the calling thread, so they must be released by the same thread
+    and are dropped automatically when the connection is closed. They never expire, `timeout` is ignored.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or app_settings.CHARGEABLE_LOCK_DATABASE
+
+    def lock_id(self, key):
+        return struct.unpack('q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+
+    def acquire_many(self, keys, timeout=None):
+        if not keys:
+            return []
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(t.id) FROM unnest(%s::bigint[]) WITH ORDINALITY AS t(id, n) '
+                           'ORDER BY t.n', [[self.lock_id(key) for key in keys]])
+            return [row[0] for row in cursor.fetchall()]
+
+    def release_many(self, keys):
+        if not keys:
+            return
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(t.id) FROM unnest(%s::bigint[]) AS t(id)',
+                           [[self.lock_id(key) for key in keys]])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from chargeable.webhooks import apply_pending
+
+
+class Command(BaseCommand):
+    help = ('Applies stored Stripe webhook events that have not been applied yet, '
+            'e.g. after a failed batch or a restart. Run it periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Events applied per transaction, CHARGEABLE_WEBHOOK_BATCH_SIZE by default.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Applied %s events' % apply_pending(options['batch_size']))
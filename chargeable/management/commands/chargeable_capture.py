@@ -0,0 +1,20 @@
+from chargeable.management.commands.chargeable_worker import Command as WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = ('Captures objects returned by `objects.due_for_capture()` of Chargeable models and releases authorizations '
+            'older than CHARGEABLE_AUTHORIZATION_MAX_AGE. Batches are claimed like chargeable_worker does.')
+
+    def add_arguments(self, parser):
+        # no --prevalidate, it validates NOT_PAID objects of chargeable_worker's queue, not the authorized ones captured here
+        self.add_worker_arguments(parser)
+
+    def process_batch(self, model, batch_size):
+        # failed captures and releases stay due and keep their claim until it runs out, see process_claimed()
+        captured = self.process_claimed(model.objects.due_for_capture().order_by('charge_date'), batch_size,
+                                        lambda objs: model.objects.capture_many(objs, concurrency=self.concurrency,
+                                                                                batch_size=batch_size))
+        released = self.process_claimed(model.objects.stale_authorizations().order_by('charge_date'), batch_size,
+                                        lambda objs: model.objects.release_stale(objs, concurrency=self.concurrency,
+                                                                                 batch_size=batch_size))
+        return captured + released
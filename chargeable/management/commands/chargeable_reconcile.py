@@ -0,0 +1,61 @@
+import json
+import sys
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from chargeable import reconcile
+from chargeable.exceptions import ReconciliationError
+from chargeable.gateways import get_gateway
+from chargeable.models import Chargeable
+
+
+class Command(BaseCommand):
+    help = ('Compares charge_id, charge_amount and charge_status of Chargeable models with gateway charges '
+            'and prints every mismatch as a JSON line.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='model',
+                            help='Models charged through the gateway account as app_label.ModelName, '
+                                 'every installed Chargeable model by default.')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--file', help='Gateway export sorted by charge id, JSON lines or .csv.')
+        source.add_argument('--api', action='store_true', default=False,
+                            help='List charges from the gateway API. Charges missing on the gateway are not reported.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at once.')
+
+    def handle(self, *args, **options):
+        querysets = [model._default_manager.all() for model in self.get_models(options['models'])]
+        if options['file']:
+            mismatches = reconcile.merge_join(reconcile.local_charges(querysets, options['chunk_size']),
+                                              reconcile.remote_charges_from_file(options['file']))
+        else:
+            mismatches = reconcile.lookup_join(querysets, reconcile.remote_charges_from_gateway(get_gateway()),
+                                               options['chunk_size'])
+
+        counts = {}
+        try:
+            for mismatch in mismatches:
+                counts[mismatch['type']] = counts.get(mismatch['type'], 0) + 1
+                self.stdout.write(json.dumps(mismatch, sort_keys=True))
+        except ReconciliationError as e:
+            raise CommandError(str(e))
+
+        summary = ', '.join('%s: %s' % item for item in sorted(counts.items())) or 'no mismatches'
+        sys.stderr.write('%s\n' % summary)
+
+    def get_models(self, labels):
+        if not labels:
+            models = [model for model in apps.get_models() if issubclass(model, Chargeable)]
+            if not models:
+                raise CommandError('No Chargeable models are installed')
+            return models
+        models = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+            if not issubclass(model, Chargeable):
+                raise CommandError('%s is not a Chargeable model' % label)
+            models.append(model)
+        return models
@@ -0,0 +1,15 @@
+from chargeable.management.commands.chargeable_worker import Command as WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = ('Charges again FAILED objects of Chargeable models whose charge_retry_at has come, see CHARGEABLE_RETRY_SCHEDULE. '
+            'Due objects are found through the (charge_status, charge_retry_at) index and claimed like chargeable_worker does.')
+
+    def add_arguments(self, parser):
+        # no --prevalidate, it validates NOT_PAID objects of chargeable_worker's queue, not the FAILED ones retried here
+        self.add_worker_arguments(parser)
+
+    def process_batch(self, model, batch_size):
+        return self.process_claimed(model.objects.due_for_retry().order_by('charge_retry_at'), batch_size,
+                                    lambda objs: model.objects.retry_many(objs, concurrency=self.concurrency,
+                                                                          batch_size=batch_size))
@@ -0,0 +1,27 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from chargeable import rollup
+from chargeable.models import Chargeable
+
+
+class Command(BaseCommand):
+    help = ('Recomputes ChargeRollup rows of Chargeable models from their tables. '
+            'Charges and refunds made while a model is rebuilt may be counted twice or missed, run it when they are paused.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', default=[],
+                            help='Model to rebuild as app_label.ModelName, can be repeated. All Chargeable models by default.')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            try:
+                models = [apps.get_model(label) for label in options['models']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+        else:
+            models = [model for model in apps.get_models() if issubclass(model, Chargeable)]
+
+        for model in models:
+            if not issubclass(model, Chargeable):
+                raise CommandError('%s is not a Chargeable model' % model._meta.label)
+            self.stdout.write('%s: %s rollup rows' % (model._meta.label, rollup.rebuild(model)))
@@ -0,0 +1,138 @@
+import logging
+import signal
+import time
+from datetime import datetime, timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from chargeable import app_settings
+from chargeable.models import Chargeable
+from chargeable.scheduler import get_circuit_breaker
+
+
+logger = logging.getLogger('chargeable')
+
+
+class Command(BaseCommand):
+    help = ('Charges objects returned by `objects.due_for_charge()` of Chargeable models. '
+            'Batches are claimed with SELECT ... FOR UPDATE SKIP LOCKED in a short transaction setting charge_claimed_until, '
+            'so any number of workers can run at once.')
+
+    stopping = False
+    concurrency = None
+
+    def add_arguments(self, parser):
+        self.add_worker_arguments(parser)
+        parser.add_argument('--prevalidate', action='store_true', default=False,
+                            help='Reject objects failing built-in checks in SQL before each pass over the queue.')
+
+    def add_worker_arguments(self, parser):
+        """Options shared by every worker command, charging specific ones are added by `add_arguments()`."""
+        parser.add_argument('--model', action='append', dest='models', default=[],
+                            help='Model to charge as app_label.ModelName, can be repeated. All Chargeable models by default.')
+        parser.add_argument('--batch-size', type=int, default=app_settings.CHARGEABLE_WORKER_BATCH_SIZE,
+                            help='Number of objects claimed at once.')
+        parser.add_argument('--concurrency', type=int, default=app_settings.CHARGEABLE_BULK_CONCURRENCY,
+                            help='Number of threads charging objects of a batch.')
+        parser.add_argument('--sleep', type=float, default=app_settings.CHARGEABLE_WORKER_IDLE_SLEEP,
+                            help='Seconds to wait when there is nothing to charge.')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Exit when there is nothing to charge instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        models = self.get_models(options['models'])
+        self.concurrency = options['concurrency']
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        claimed = 0
+        breaker = get_circuit_breaker()
+        while not self.stopping:
+            if breaker is not None and breaker.is_open():
+                logger.info('Gateway circuit breaker is open, waiting')
+                self.wait(options['sleep'])
+                continue
+            if options.get('prevalidate') and not claimed:
+                for model in models:
+                    model.objects.charge_candidates()
+            claimed = sum(self.process_batch(model, options['batch_size']) for model in models)
+            if not claimed:
+                if options['once']:
+                    break
+                self.wait(options['sleep'])
+
+        logger.info('Charge worker stopped')
+
+    def get_models(self, labels):
+        if labels:
+            try:
+                models = [apps.get_model(label) for label in labels]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+        else:
+            models = [model for model in apps.get_models() if issubclass(model, Chargeable)]
+
+        for model in models:
+            if not issubclass(model, Chargeable):
+                raise CommandError('%s is not a Chargeable model' % model._meta.label)
+        return models
+
+    def process_batch(self, model, batch_size):
+        return self.process_claimed(model.objects.due_for_charge().order_by('pk'), batch_size,
+                                    lambda objs: model.objects.charge_many(objs, concurrency=self.concurrency,
+                                                                           batch_size=batch_size))
+
+    def process_claimed(self, queryset, batch_size, func):
+        """
+        Claim a batch of `queryset` and call bulk `func` (e.g. `charge_many`) with it.
+        Returns number of objects that left `queryset`: deferred objects and objects locked by somebody else
+        are released to be claimed again after waiting, objects still due after an unexpected error
+        keep their claim until it runs out instead of being claimed again at once.
+        """
+        objs = self.claim(queryset, batch_size)
+        if not objs:
+            return 0
+        try:
+            results = func(objs)
+        except Exception:
+            self.release(queryset.model, objs)
+            raise
+        waiting = set(obj.pk for obj in results.get('deferred', []) + results['lock_skipped'])
+        still_due = set(queryset.filter(pk__in=[obj.pk for obj in objs]).values_list('pk', flat=True))
+        errored = still_due - waiting
+        if errored:
+            logger.warning('%s %s objects are still due after processing, retried in %ss',
+                           len(errored), queryset.model._meta.label, app_settings.CHARGEABLE_WORKER_CLAIM_TIME)
+        self.release(queryset.model, [obj for obj in objs if obj.pk not in errored])
+        return len(objs) - len(waiting) - len(errored)
+
+    def claim(self, queryset, batch_size):
+        """
+        Claim up to `batch_size` objects of `queryset` for CHARGEABLE_WORKER_CLAIM_TIME seconds.
+        The claiming transaction is committed before any gateway call, objects of a killed worker
+        are claimed again once their claim runs out and charged with the same idempotency keys.
+        """
+        now = datetime.now()
+        with transaction.atomic():
+            queryset = queryset.filter(Q(charge_claimed_until__isnull=True) | Q(charge_claimed_until__lt=now))
+            objs = list(queryset.select_for_update(skip_locked=True, of=('self',))[:batch_size])
+            claimed_until = now + timedelta(seconds=app_settings.CHARGEABLE_WORKER_CLAIM_TIME)
+            queryset.model._default_manager.filter(pk__in=[obj.pk for obj in objs])\
+                .update(charge_claimed_until=claimed_until)
+        return objs
+
+    def release(self, model, objs):
+        """Drop the claim on `objs` once their outcomes are written, objects still due are claimed by the next pass."""
+        if objs:
+            model._default_manager.filter(pk__in=[obj.pk for obj in objs]).update(charge_claimed_until=None)
+
+    def wait(self, seconds):
+        deadline = time.time() + seconds
+        while not self.stopping and time.time() < deadline:
+            time.sleep(min(1, seconds))
+
+    def stop(self, signum, frame):
+        logger.info('Charge worker got signal %s, finishing current batch', signum)
+        self.stopping = True
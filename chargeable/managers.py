@@ -1,5 +1,26 @@
+import logging
+import math
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
 from django.db import models
+from django.db.models import Count, DateField, Q, Sum
+from django.db.models.functions import Coalesce, Trunc
+from chargeable import app_settings
+from chargeable.buffers import OutcomeBuffer, get_attempt_log
+from chargeable.locks import get_lock_backend
+from chargeable.scheduler import get_scheduler
 from chargeable.choices import *
+from chargeable.utils import chunked, run_concurrently, run_in_executor
+
+
+logger = logging.getLogger('chargeable')
+
+CHARGE_OUTCOMES = ('charged', 'failed', 'validation_failed', 'lock_skipped', 'deferred')
+REFUND_OUTCOMES = ('refunded', 'failed', 'validation_failed', 'lock_skipped')
+CAPTURE_OUTCOMES = ('captured', 'failed', 'validation_failed', 'lock_skipped', 'deferred')
+RELEASE_OUTCOMES = ('released', 'failed', 'validation_failed', 'lock_skipped')
+REPORT_PERIODS = ('day', 'week')
 
 
 class ChargeableManager(models.Manager):
@@ -11,4 +32,392 @@ class ChargeableManager(models.Manager):
         return self.filter(charge_status=FAILED, **kwargs)
 
     def refunded(self, **kwargs):
-        return self.filter(charge_status=REFUNDED, **kwargs)
\ No newline at end of file
+        return self.filter(charge_status=REFUNDED, **kwargs)
+
+    def authorized(self, **kwargs):
+        return self.filter(charge_status=AUTHORIZED, **kwargs)
+
+    def due_for_charge(self, **kwargs):
+        """Objects that are waiting to be charged, override to add business conditions."""
+        return self.filter(charge_status=NOT_PAID, **kwargs)
+
+    def charge_candidates(self, queryset=None):
+        """
+        Runs built-in charge validation in SQL: NOT_PAID objects that are already charged
+        (or, when `payer_field` is set on the model, have no active payer with stripe token)
+        are marked VALIDATION_FAILED with one UPDATE per reason, `validation_failed` hook is not called for them.
+        Returns queryset of the remaining NOT_PAID objects, with their payers when `payer_field` is set.
+        """
+        if queryset is None:
+            queryset = self.due_for_charge()
+        queryset = queryset.filter(charge_status=NOT_PAID)
+        name = self.model.__name__
+
+        rejections = [
+            ((Q(charge_id__isnull=False) & ~Q(charge_id='')) | Q(charge_amount__isnull=False),
+             '%s has already been charged' % name),
+        ]
+        payer_field = self.model.payer_field
+        if payer_field:
+            rejections += [
+                (Q(**{payer_field: None}) | Q(**{'%s__stripe_token__isnull' % payer_field: True}) |
+                 Q(**{'%s__stripe_token' % payer_field: ''}),
+                 '%s does not belong to active customer' % name),
+                (Q(**{'%s__is_active' % payer_field: False}),
+                 '%s is not an active customer' % name),
+            ]
+
+        for condition, message in rejections:
+            count = queryset.filter(condition).update(charge_status=VALIDATION_FAILED, charge_info=message)
+            if count:
+                logger.info('Validation failed for %s %s objects: %s', count, name, message)
+        if payer_field:
+            # charge() checks the payer again, loaded with the objects it is one query per batch, not per object
+            queryset = queryset.select_related(payer_field)
+        return queryset
+
+    def charge_many(self, queryset=None, concurrency=None, batch_size=None, prevalidate=False, **kwargs):
+        """
+        Charge every object of `queryset` (`due_for_charge()` by default) on a pool of `concurrency` threads.
+        Objects are loaded and charged in batches of `batch_size`, `kwargs` are passed to `charge()`.
+        Outcomes of every batch are written with `bulk_update`, `post_charge` hooks run after that.
+        With `prevalidate` built-in checks are done in SQL first, see `charge_candidates()`.
+        Returns dict mapping outcome ('charged', 'failed', 'validation_failed', 'lock_skipped', 'deferred')
+        to list of objects.
+        """
+        if queryset is None:
+            queryset = self.due_for_charge()
+        if prevalidate:
+            queryset = self.charge_candidates(queryset)
+        return self._charge_each(queryset, concurrency, batch_size, False, kwargs)
+
+    def due_for_retry(self, now=None, **kwargs):
+        """
+        FAILED objects whose next retry time has come,
+        found with a range scan of the (charge_status, charge_retry_at) index.
+        """
+        return self.filter(charge_retry_at__lte=now or datetime.now(), charge_status=FAILED, **kwargs)
+
+    def retry_many(self, queryset=None, concurrency=None, batch_size=None, **kwargs):
+        """
+        Charge FAILED objects of `queryset` (`due_for_retry()` by default) again like `charge_many()` does.
+        A failed retry schedules the next one from CHARGEABLE_RETRY_SCHEDULE until the schedule runs out.
+        """
+        if queryset is None:
+            queryset = self.due_for_retry().order_by('charge_retry_at')
+        return self._charge_each(queryset, concurrency, batch_size, True, kwargs)
+
+    def _charge_each(self, queryset, concurrency, batch_size, retry, kwargs):
+        concurrency = concurrency or app_settings.CHARGEABLE_BULK_CONCURRENCY
+        batch_size = batch_size or app_settings.CHARGEABLE_BULK_BATCH_SIZE
+
+        def charge(obj):
+            try:
+                if retry:
+                    obj.prepare_retry()
+                obj.charge(**kwargs)
+            except Exception:
+                logger.exception('Unexpected error while charging %s %s', obj.__class__.__name__, obj.pk)
+                return 'failed'
+            return self._charge_outcome(obj)
+
+        results = dict((outcome, []) for outcome in CHARGE_OUTCOMES)
+        objects = queryset.iterator() if hasattr(queryset, 'iterator') else queryset
+        for batch in chunked(objects, batch_size):
+            outcomes, skipped = self._process_batch(batch, charge, concurrency, prime_amounts=True)
+            results['lock_skipped'].extend(skipped)
+            for obj, outcome in outcomes:
+                results[outcome].append(obj)
+        return results
+
+    def charge_consolidated(self, queryset=None, concurrency=None, batch_size=None, **kwargs):
+        """
+        Charge objects of `queryset` (`due_for_charge()` by default) grouped by payer: every payer gets one gateway
+        charge for the combined amount of its valid objects, see `Chargeable.charge_consolidated()`.
+        When the model sets `payer_field` objects are ordered by payer so a payer is never split between batches,
+        otherwise objects are grouped within batches of `batch_size`.
+        Returns dict mapping outcome ('charged', 'failed', 'validation_failed', 'lock_skipped', 'deferred')
+        to list of objects.
+        """
+        if queryset is None:
+            queryset = self.due_for_charge()
+        payer_field = self.model.payer_field if self.model is not None else None
+        if payer_field and hasattr(queryset, 'order_by'):
+            queryset = queryset.select_related(payer_field).order_by(payer_field, 'pk')
+        concurrency = concurrency or app_settings.CHARGEABLE_BULK_CONCURRENCY
+        batch_size = batch_size or app_settings.CHARGEABLE_BULK_BATCH_SIZE
+
+        def charge(group):
+            try:
+                type(group[0]).charge_consolidated(group, **kwargs)
+            except Exception:
+                logger.exception('Unexpected error while charging %s %s', group[0].__class__.__name__,
+                                 [obj.pk for obj in group])
+                return False
+            return True
+
+        results = dict((outcome, []) for outcome in CHARGE_OUTCOMES)
+        objects = queryset.iterator() if hasattr(queryset, 'iterator') else queryset
+        for batch in self._payer_batches(objects, batch_size):
+            outcomes, skipped = self._process_batch(batch, charge, concurrency, prime_amounts=True,
+                                                    grouper=self._group_by_payer)
+            results['lock_skipped'].extend(skipped)
+            for group, succeeded in outcomes:
+                for obj in group:
+                    results[self._charge_outcome(obj) if succeeded else 'failed'].append(obj)
+        return results
+
+    def _payer_key(self, obj):
+        payer = obj.payer
+        return ('obj', obj.pk) if payer is None else ('payer', payer.id)
+
+    def _payer_batches(self, objects, batch_size):
+        """Split `objects` into batches of about `batch_size`, never between two consecutive objects of one payer."""
+        batch, last_key = [], None
+        for obj in objects:
+            key = self._payer_key(obj)
+            if len(batch) >= batch_size and key != last_key:
+                yield batch
+                batch = []
+            batch.append(obj)
+            last_key = key
+        if batch:
+            yield batch
+
+    def _group_by_payer(self, objs):
+        groups = OrderedDict()
+        for obj in objs:
+            groups.setdefault(self._payer_key(obj), []).append(obj)
+        return list(groups.values())
+
+    def refund_many(self, queryset, amount=None, reason=None, concurrency=None, batch_size=None, **kwargs):
+        """
+        Refund every object of `queryset` on a pool of `concurrency` threads,
+        `amount`, `reason` and `kwargs` are passed to `refund()`. There is no default, refunds are never table wide.
+        Returns dict mapping outcome ('refunded', 'failed', 'validation_failed', 'lock_skipped') to list of objects.
+        """
+        def refund(obj):
+            if not obj.is_valid_for_refund(amount, **kwargs):
+                return 'validation_failed'
+            try:
+                return 'refunded' if obj.refund(amount=amount, reason=reason, **kwargs) else 'failed'
+            except Exception:
+                logger.exception('Unexpected error while refunding %s %s', obj.__class__.__name__, obj.pk)
+                return 'failed'
+
+        return self._run_each(queryset, refund, REFUND_OUTCOMES, concurrency, batch_size)
+
+    def due_for_capture(self, **kwargs):
+        """Authorized objects that are ready to be captured, override to add business conditions."""
+        return self.authorized(**kwargs)
+
+    def stale_authorizations(self, max_age=None, **kwargs):
+        """Objects authorized more than `max_age` (CHARGEABLE_AUTHORIZATION_MAX_AGE by default) seconds ago."""
+        max_age = max_age or app_settings.CHARGEABLE_AUTHORIZATION_MAX_AGE
+        return self.authorized(charge_date__lt=datetime.now() - timedelta(seconds=max_age), **kwargs)
+
+    def capture_many(self, queryset=None, concurrency=None, batch_size=None, **kwargs):
+        """
+        Capture every authorized object of `queryset` (`due_for_capture()` by default) on a pool of `concurrency` threads,
+        `kwargs` are passed to `capture()`. Outcomes of every batch are written with `bulk_update`.
+        Returns dict mapping outcome ('captured', 'failed', 'validation_failed', 'lock_skipped', 'deferred')
+        to list of objects.
+        """
+        if queryset is None:
+            queryset = self.due_for_capture()
+
+        def capture(obj):
+            if not obj.is_valid_for_capture(kwargs.get('amount')):
+                return 'validation_failed'
+            try:
+                if obj.capture(**kwargs):
+                    return 'captured'
+            except Exception:
+                logger.exception('Unexpected error while capturing %s %s', obj.__class__.__name__, obj.pk)
+                return 'failed'
+            # objects are locked with their batch, a capture returning False either was deferred or failed
+            return 'deferred' if obj.charge_deferred else 'failed'
+
+        return self._run_each(queryset, capture, CAPTURE_OUTCOMES, concurrency, batch_size)
+
+    def release_stale(self, queryset=None, max_age=None, concurrency=None, batch_size=None):
+        """
+        Release authorizations of `queryset` (`stale_authorizations(max_age)` by default) in batches.
+        Returns dict mapping outcome ('released', 'failed', 'validation_failed', 'lock_skipped') to list of objects.
+        """
+        if queryset is None:
+            queryset = self.stale_authorizations(max_age)
+
+        def release(obj):
+            if not obj.is_valid_for_capture():
+                return 'validation_failed'
+            try:
+                if obj.release():
+                    return 'released'
+            except Exception:
+                logger.exception('Unexpected error while releasing %s %s', obj.__class__.__name__, obj.pk)
+            return 'failed'
+
+        return self._run_each(queryset, release, RELEASE_OUTCOMES, concurrency, batch_size)
+
+    async def acapture_many(self, queryset=None, concurrency=None, batch_size=None, **kwargs):
+        """Async version of `capture_many()`."""
+        return await run_in_executor(self.capture_many, queryset, concurrency=concurrency, batch_size=batch_size, **kwargs)
+
+    def _run_each(self, queryset, func, outcomes, concurrency, batch_size):
+        concurrency = concurrency or app_settings.CHARGEABLE_BULK_CONCURRENCY
+        batch_size = batch_size or app_settings.CHARGEABLE_BULK_BATCH_SIZE
+        results = dict((outcome, []) for outcome in outcomes)
+        objects = queryset.iterator() if hasattr(queryset, 'iterator') else queryset
+        for batch in chunked(objects, batch_size):
+            batch_outcomes, skipped = self._process_batch(batch, func, concurrency)
+            results['lock_skipped'].extend(skipped)
+            for obj, outcome in batch_outcomes:
+                results[outcome].append(obj)
+        return results
+
+    def _process_batch(self, batch, func, concurrency, prime_amounts=False, grouper=None):
+        """
+        Locks `batch` for `batch_lock_time()` with one lock backend call, runs `func` for every locked object on `concurrency` threads,
+        writes outcomes with bulk_update (and logged attempts with bulk_create) and releases the locks.
+        Gateway calls go through the shared scheduler.
+        With `grouper` locked objects are split into lists and `func` is called once per list.
+        Returns list of (obj or list, result) pairs and list of objects that were locked by somebody else.
+        """
+        backend = get_lock_backend()
+        scheduler = get_scheduler()
+        acquired = backend.acquire_many([obj._lock_key for obj in batch],
+                                        self.batch_lock_time(len(batch), concurrency, scheduler))
+        locked = [obj for obj, ok in zip(batch, acquired) if ok]
+        skipped = [obj for obj, ok in zip(batch, acquired) if not ok]
+
+        buffer = OutcomeBuffer()
+        try:
+            unpriced = self.prime_charge_amounts(locked) if prime_amounts else []
+            for obj in locked:
+                obj._outcome_buffer = buffer
+                obj._lock_held = True
+                obj._scheduler = scheduler
+            items = locked
+            if grouper:
+                # objects whose amount failed are charged on their own, their error does not fail a payer's group
+                unpriced_ids = set(id(obj) for obj in unpriced)
+                items = grouper([obj for obj in locked if id(obj) not in unpriced_ids]) + [[obj] for obj in unpriced]
+            outcomes = run_concurrently(func, items, concurrency)
+        finally:
+            try:
+                buffer.flush()
+                if app_settings.CHARGEABLE_ATTEMPT_LOG:
+                    get_attempt_log().flush()
+            finally:
+                for obj in locked:
+                    obj._outcome_buffer = None
+                    obj._lock_held = False
+                    obj._scheduler = None
+                    obj._cached_charge_amount = None
+                backend.release_many([obj._lock_key for obj in locked])
+        return outcomes, skipped
+
+    def batch_lock_time(self, size, concurrency, scheduler):
+        """
+        Seconds locks of a batch of `size` objects are held for: CHARGEABLE_CHARGE_LOCK_TIME per wave of `concurrency`
+        calls plus the pacing and backoff `scheduler` may add, so locks outlive the slowest batch until it is written.
+        """
+        waves = math.ceil(size / float(max(1, concurrency)))
+        return int(math.ceil(waves * app_settings.CHARGEABLE_CHARGE_LOCK_TIME + scheduler.max_delay(size, concurrency)))
+
+    def prime_charge_amounts(self, objs):
+        """
+        Compute amounts of `objs` with one `get_charge_amounts()` call and keep them for their next charge.
+        When that call raises amounts are computed one by one. Returns list of objects whose amount raised,
+        their charge computes it again and reports the error for them only.
+        """
+        if not objs:
+            return []
+        failed = []
+        try:
+            amounts = type(objs[0]).get_charge_amounts(objs)
+        except Exception:
+            logger.exception('Computing amounts of %s %s objects failed, computing them one by one',
+                             len(objs), type(objs[0]).__name__)
+            amounts = {}
+            for obj in objs:
+                try:
+                    amounts[obj.pk] = obj.get_charge_amount()
+                except Exception:
+                    failed.append(obj)
+        for obj in objs:
+            if obj.pk in amounts:
+                obj._cached_charge_amount = amounts[obj.pk]
+        return failed
+
+    async def acharge_many(self, queryset=None, concurrency=None, batch_size=None, **kwargs):
+        """Async version of `charge_many()`."""
+        return await run_in_executor(self.charge_many, queryset, concurrency=concurrency, batch_size=batch_size, **kwargs)
+
+    def _charge_outcome(self, obj):
+        if obj.charge_deferred:
+            return 'deferred'
+        if obj.charge_status == PAID:
+            return 'charged'
+        if obj.charge_status == FAILED:
+            return 'failed'
+        if obj.charge_status == VALIDATION_FAILED:
+            return 'validation_failed'
+        return 'lock_skipped'
+
+    def report(self, period='day', statuses=None, by_status=True, start=None, end=None, **kwargs):
+        """
+        Number of objects and sum of charge_amount per `period` ('day' or 'week' of charge_date)
+        and, with `by_status`, per charge_status, computed with one aggregate query.
+        With CHARGEABLE_ROLLUP and no extra filters in `kwargs` totals are read from ChargeRollup,
+        `start` and `end` are then applied to whole days.
+        Returns values queryset of dicts with `period` (date), `charge_status`, `count` and `amount`, ordered by period.
+        """
+        if period not in REPORT_PERIODS:
+            raise ValueError('Unknown report period %r, expected one of %s' % (period, ', '.join(REPORT_PERIODS)))
+        if app_settings.CHARGEABLE_ROLLUP and not kwargs:
+            return self._rollup_report(period, statuses, by_status, start, end)
+
+        queryset = self.filter(charge_date__isnull=False, **kwargs)
+        if statuses is not None:
+            queryset = queryset.filter(charge_status__in=statuses)
+        if start is not None:
+            queryset = queryset.filter(charge_date__gte=start)
+        if end is not None:
+            queryset = queryset.filter(charge_date__lt=end)
+
+        group_by = ['period', 'charge_status'] if by_status else ['period']
+        return queryset.annotate(period=Trunc('charge_date', period, output_field=DateField()))\
+            .values(*group_by)\
+            .annotate(count=Count('pk'), amount=Coalesce(Sum('charge_amount'), 0))\
+            .order_by(*group_by)
+
+    def _rollup_report(self, period, statuses, by_status, start, end):
+        from chargeable.models import ChargeRollup
+
+        queryset = ChargeRollup.objects.using(self.db).filter(model=self.model._meta.label)
+        if statuses is not None:
+            queryset = queryset.filter(charge_status__in=statuses)
+        if start is not None:
+            queryset = queryset.filter(day__gte=start.date() if isinstance(start, datetime) else start)
+        if end is not None:
+            queryset = queryset.filter(day__lt=end.date() if isinstance(end, datetime) else end)
+
+        group_by = ['period', 'charge_status'] if by_status else ['period']
+        return queryset.annotate(period=Trunc('day', period, output_field=DateField()))\
+            .values(*group_by)\
+            .annotate(count=Sum('total_count'), amount=Sum('total_amount'))\
+            .order_by(*group_by)
+
+    def revenue(self, period='day', start=None, end=None, **kwargs):
+        """Charged amount per period, partially refunded objects count with their full charge_amount."""
+        return self.report(period, [PAID, PARTIALLY_REFUNDED], False, start, end, **kwargs)
+
+    def refunds(self, period='day', start=None, end=None, **kwargs):
+        """Refunded and partially refunded objects per period of their charge_date."""
+        return self.report(period, [REFUNDED, PARTIALLY_REFUNDED], False, start, end, **kwargs)
+
+    def failures(self, period='day', start=None, end=None, **kwargs):
+        """Failed objects per period of their last failed attempt."""
+        return self.report(period, [FAILED], False, start, end, **kwargs)
@@ -0,0 +1,141 @@
+import threading
+from collections import defaultdict
+from timeit import default_timer
+
+from django.utils.module_loading import import_string
+from chargeable import app_settings
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return process wide metrics sink configured by CHARGEABLE_METRICS_BACKEND."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = import_string(app_settings.CHARGEABLE_METRICS_BACKEND)()
+    return _metrics
+
+
+class Timer(object):
+
+    def __init__(self, metrics, name, tags):
+        self.metrics = metrics
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.timing(self.name, default_timer() - self.start, **self.tags)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class BaseMetrics(object):
+    """
+    Sink for charge and refund metrics. Timings are named after the phase ('charge.validate', 'charge.lock',
+    'charge.gateway', 'charge.save', 'refund.*', 'bulk.flush'), counters after the outcome ('charge.succeeded',
+    'charge.failed', 'charge.validation_failed', 'charge.lock_skipped', 'refund.*'). Tags hold the model name.
+    """
+
+    def timing(self, name, seconds, **tags):
+        raise NotImplementedError
+
+    def incr(self, name, value=1, **tags):
+        raise NotImplementedError
+
+    def timer(self, name, **tags):
+        return Timer(self, name, tags)
+
+
+class NullMetrics(BaseMetrics):
+
+    _timer = NullTimer()
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+    def incr(self, name, value=1, **tags):
+        pass
+
+    def timer(self, name, **tags):
+        return self._timer
+
+
+class InMemoryMetrics(BaseMetrics):
+    """Keeps every timing and counter in memory, for tests and benchmarks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = defaultdict(list)
+            self.counters = defaultdict(int)
+
+    def timing(self, name, seconds, **tags):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def incr(self, name, value=1, **tags):
+        with self._lock:
+            self.counters[name] += value
+
+    def percentile(self, name, percent):
+        with self._lock:
+            values = sorted(self.timings[name])
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+class StatsdMetrics(BaseMetrics):
+    """Sends metrics with the `statsd` package, model tag is appended to the metric name."""
+
+    def __init__(self, host=None, port=None, prefix=None):
+        from statsd import StatsClient
+
+        self.client = StatsClient(host or app_settings.CHARGEABLE_METRICS_STATSD_HOST,
+                                  port or app_settings.CHARGEABLE_METRICS_STATSD_PORT,
+                                  prefix=prefix or app_settings.CHARGEABLE_METRICS_PREFIX)
+
+    def _name(self, name, tags):
+        return '%s.%s' % (name, tags['model']) if tags.get('model') else name
+
+    def timing(self, name, seconds, **tags):
+        self.client.timing(self._name(name, tags), seconds * 1000)
+
+    def incr(self, name, value=1, **tags):
+        self.client.incr(self._name(name, tags), value)
+
+
+class PrometheusMetrics(BaseMetrics):
+    """Exports metrics with the `prometheus_client` package, as one histogram and one counter labeled by name."""
+
+    def __init__(self, prefix=None):
+        from prometheus_client import Counter, Histogram
+
+        prefix = prefix or app_settings.CHARGEABLE_METRICS_PREFIX
+        self.histogram = Histogram('%s_phase_seconds' % prefix, 'Duration of charge and refund phases',
+                                   ['name', 'model'])
+        self.counter = Counter('%s_events_total' % prefix, 'Charge and refund outcomes', ['name', 'model'])
+
+    def timing(self, name, seconds, **tags):
+        self.histogram.labels(name=name, model=tags.get('model', '')).observe(seconds)
+
+    def incr(self, name, value=1, **tags):
+        self.counter.labels(name=name, model=tags.get('model', '')).inc(value)
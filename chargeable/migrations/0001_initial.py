@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargeRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('day', models.DateField()),
+                ('charge_status', models.IntegerField(choices=[(0, 'Not paid'), (10, 'Paid'), (20, 'Failed'), (30, 'Refunded'), (31, 'Partially refunded'), (40, 'Validation Failed'), (50, 'Disputed')])),
+                ('total_count', models.BigIntegerField(default=0)),
+                ('total_amount', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('model', 'day', 'charge_status')},
+            },
+        ),
+    ]
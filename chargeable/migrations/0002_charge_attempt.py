@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-17 13:47
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chargeable', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargeAttempt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.CharField(max_length=64)),
+                ('operation', models.CharField(choices=[('charge', 'Charge'), ('refund', 'Refund')], max_length=10)),
+                ('charge_status', models.IntegerField(choices=[(0, 'Not paid'), (10, 'Paid'), (20, 'Failed'), (30, 'Refunded'), (31, 'Partially refunded'), (40, 'Validation Failed'), (50, 'Disputed')])),
+                ('amount', models.IntegerField(blank=True, null=True)),
+                ('charge_id', models.CharField(blank=True, max_length=32, null=True)),
+                ('error', models.CharField(blank=True, max_length=255, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('created', models.DateTimeField(default=datetime.datetime.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='chargeattempt',
+            index=models.Index(fields=['model', 'object_id', 'created'], name='chargeable__model_8ac614_idx'),
+        ),
+    ]
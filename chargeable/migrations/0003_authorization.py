@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chargeable', '0002_charge_attempt'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chargeattempt',
+            name='charge_status',
+            field=models.IntegerField(choices=[(0, 'Not paid'), (5, 'Authorized'), (10, 'Paid'), (20, 'Failed'), (30, 'Refunded'), (31, 'Partially refunded'), (40, 'Validation Failed'), (50, 'Disputed')]),
+        ),
+        migrations.AlterField(
+            model_name='chargeattempt',
+            name='operation',
+            field=models.CharField(choices=[('charge', 'Charge'), ('authorize', 'Authorize'), ('capture', 'Capture'), ('release', 'Release'), ('refund', 'Refund')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='chargerollup',
+            name='charge_status',
+            field=models.IntegerField(choices=[(0, 'Not paid'), (5, 'Authorized'), (10, 'Paid'), (20, 'Failed'), (30, 'Refunded'), (31, 'Partially refunded'), (40, 'Validation Failed'), (50, 'Disputed')]),
+        ),
+    ]
@@ -1,20 +1,33 @@
+import hashlib
 import sys
-import stripe
+import uuid
 import logging
+from functools import partial
+from timeit import default_timer
 
-from datetime import datetime
-from django.conf import settings
-from django.core.cache import cache
+from datetime import datetime, timedelta
 from django.db import models
-from stripe.error import StripeError
-from chargeable import app_settings
-from chargeable.exceptions import ValidationError
+from django.urls import get_script_prefix, reverse
+from django.utils.html import format_html
+from stripe.error import CardError, StripeError
+from chargeable import app_settings, rollup
+from chargeable.buffers import get_attempt_log
+from chargeable.exceptions import CircuitOpenError, ValidationError, error_message
+from chargeable.gateways import get_gateway
+from chargeable.locks import get_lock_backend
+from chargeable.metrics import get_metrics
+from chargeable.scheduler import get_circuit_breaker
 from chargeable.managers import ChargeableManager
 from chargeable.choices import *
+from chargeable.utils import run_in_executor
 
 
 logger = logging.getLogger('chargeable')
 
+# Admin refund URL per (script prefix, model label) with ADMIN_URL_PK in place of the object id
+ADMIN_URL_PK = '__pk__'
+_admin_refund_urls = {}
+
 
 class Chargeable(models.Model):
     charge_id = models.CharField(max_length=32, blank=True, null=True)
@@ -22,14 +35,63 @@ class Chargeable(models.Model):
     charge_amount = models.IntegerField(null=True, blank=True)
     charge_info = models.CharField(max_length=255, null=True, blank=True)
     charge_date = models.DateTimeField(null=True, blank=True)
+    charge_retry_at = models.DateTimeField(null=True, blank=True)
+    charge_retry_count = models.PositiveIntegerField(default=0)
+    # Set by chargeable_worker while it charges the object, rows claimed until a later time are skipped by other workers
+    charge_claimed_until = models.DateTimeField(null=True, blank=True)
 
     charge_error_msg = None
     refund_error_msg = None
+    # Set when the gateway circuit breaker is open, the object stays NOT_PAID and is not saved
+    charge_deferred = False
+
+    # Name of the relation to payer, lets ChargeableManager.charge_candidates() check payers in SQL
+    payer_field = None
+
+    # Stored in charge_info of objects sharing one consolidated charge, see charge_consolidated()
+    CONSOLIDATED_CHARGE_INFO = 'Consolidated charge of %s objects'
+
+    # Fields written by charge(), nothing else of the row is saved
+    CHARGE_FIELDS = ['charge_id', 'charge_status', 'charge_amount', 'charge_info', 'charge_date',
+                     'charge_retry_at', 'charge_retry_count']
+
+    DEFERRED_CHARGE_MSG = 'Gateway is unavailable, charge deferred'
+    RELEASED_CHARGE_INFO = 'Authorization released'
+    # Failures retried on CHARGEABLE_RETRY_SCHEDULE. After other errors it is unknown whether the charge went through,
+    # a retry has a new idempotency key and could charge twice, so such objects are only retried by hand.
+    RETRIED_ERRORS = (CardError,)
+
+    _cached_charge_amount = None
+    # Set while charge(), authorize() or charge_consolidated() runs, amounts are only kept in between
+    _charging = False
+    # Set by bulk operations to write outcomes with bulk_update instead of save()
+    _outcome_buffer = None
+    # Set by bulk operations which acquire and release locks for the whole batch
+    _lock_held = False
+    # Set by bulk operations to pace and retry gateway calls, see chargeable.scheduler
+    _scheduler = None
+    # (day, status, amount) the object is counted in by ChargeRollup as loaded from the database
+    _rollup_state = None
 
     objects = ChargeableManager()
 
     class Meta:
         abstract = True
+        # Inherited by subclasses, a subclass declaring its own Meta must extend Chargeable.Meta to keep them
+        indexes = [
+            models.Index(fields=['charge_status', 'charge_date']),
+            models.Index(fields=['charge_id']),
+            models.Index(fields=['charge_status', 'charge_retry_at']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super(Chargeable, cls).from_db(db, field_names, values)
+        if all(name in field_names for name in ('charge_status', 'charge_date', 'charge_amount')):
+            obj._rollup_state = rollup.bucket(obj)
+        else:
+            obj._rollup_state = rollup.UNKNOWN
+        return obj
 
     @property
     def payer(self):
@@ -39,44 +101,222 @@ class Chargeable(models.Model):
     def is_charged(self):
         return self.charge_status == PAID
 
+    @property
+    def is_authorized(self):
+        return self.charge_status == AUTHORIZED
+
+    @property
+    def _payer_id(self):
+        """Id of payer for log messages, None for payer-less objects."""
+        return getattr(self.payer, 'id', None)
+
     @property
     def _lock_key(self):
         return 'chargeable_lock_%s_%s' % (self.__class__.__name__, self.id)
 
     def charge(self, **kwargs):
-        stripe.api_key = settings.STRIPE_API_KEY
-        if self.is_valid_for_charge(**kwargs) and self._lock():
-            try:
-                self.pre_charge(**kwargs)
-                amount = self.get_charge_amount()
-                logger.info('Charging payer(%s): %s' % (self.payer.id, amount))
-                if amount >= app_settings.CHARGEABLE_STRIPE_MINIMUM_CHARGE_AMOUNT:
-                    charge = stripe.resource.Charge.create(amount=amount,
-                                                           customer=self.payer.stripe_token,
-                                                           currency='usd',
-                                                           description=self.get_charge_description()
-                    )
-                    logger.info('Charged payer(%s): %s' % (self.payer.id, amount))
-                    self.charge_id = charge.id
-                    amount = charge.amount
-                self.charge_amount = amount
-                self.charge_status = PAID
-                self.charge_date = datetime.now()
+        self._charging = True
+        try:
+            return self._charge(True, **kwargs)
+        finally:
+            self._charging = False
+            self._cached_charge_amount = None
+
+    def authorize(self, **kwargs):
+        """
+        Like `charge()`, but the amount is only authorized and the object becomes AUTHORIZED.
+        Capture it later with `capture()` or `ChargeableManager.capture_many()`.
+        """
+        self._charging = True
+        try:
+            return self._charge(False, **kwargs)
+        finally:
+            self._charging = False
+            self._cached_charge_amount = None
+
+    def _charge(self, capture, **kwargs):
+        metrics = get_metrics()
+        model = self.__class__.__name__
+        started = default_timer()
+        self.charge_deferred = False
+        with metrics.timer('charge.validate', model=model):
+            is_valid = self.is_valid_for_charge(**kwargs)
+        operation = 'charge' if capture else 'authorize'
+        if not is_valid:
+            metrics.incr('charge.validation_failed', model=model)
+            self._log_attempt(operation, None, self.charge_info, started)
+            return self.is_charged
+        with metrics.timer('charge.lock', model=model):
+            is_locked = self._lock()
+        if not is_locked:
+            metrics.incr('charge.lock_skipped', model=model)
+            return self.is_charged or (not capture and self.is_authorized)
+
+        amount = None
+        try:
+            self.pre_charge(**kwargs)
+            amount = self._get_charge_amount()
+            logger.info('Charging payer(%s): %s', self._payer_id, amount)
+            if amount >= app_settings.CHARGEABLE_STRIPE_MINIMUM_CHARGE_AMOUNT:
+                # capture is only passed when off, gateways written before authorization support keep working
+                options = {} if capture else {'capture': False}
+                with metrics.timer('charge.gateway', model=model):
+                    charge = self._call_gateway(get_gateway().charge,
+                                                amount=amount,
+                                                customer=self.payer.stripe_token,
+                                                description=self.get_charge_description(),
+                                                idempotency_key=self._idempotency_key(operation),
+                                                **options)
+                logger.info('%s payer(%s): %s', 'Charged' if capture else 'Authorized', self._payer_id, amount)
+                self.charge_id = charge.id
+                amount = charge.amount
+            self.charge_amount = amount
+            # amounts below the gateway minimum are not sent, there is nothing to capture later
+            self.charge_status = PAID if capture or not self.charge_id else AUTHORIZED
+            self.charge_date = datetime.now()
+            self.charge_retry_at = None
+            if self.is_authorized:
+                metrics.incr('charge.authorized', model=model)
+                self.charge_authorized(amount, **kwargs)
+            else:
+                metrics.incr('charge.succeeded', model=model)
                 self.charge_succeeded(amount, **kwargs)
-            except StripeError as e:
-                self.charge_status = FAILED
-                exc_type, exc_value, _ = sys.exc_info()
-                self.charge_info = exc_value.message
-                self.charge_error_msg = exc_value.message
-                logger.warning('Charge failed amount(%s) payer(%s):%s - %s' % (
-                    amount, self.payer.id, exc_type, exc_value.message
-                ))
-                self.charge_failed(e, **kwargs)
-            finally:
-                self.save()
+        except CircuitOpenError:
+            self.charge_deferred = True
+            self.charge_error_msg = self.DEFERRED_CHARGE_MSG
+            logger.warning('Charge deferred amount(%s) payer(%s): gateway circuit breaker is open', amount, self._payer_id)
+            metrics.incr('charge.deferred', model=model)
+        except StripeError as e:
+            self.charge_status = FAILED
+            # failures are reported and rolled up by the date of the failed attempt
+            self.charge_date = datetime.now()
+            if isinstance(e, self.RETRIED_ERRORS):
+                self.schedule_retry()
+            else:
+                self.charge_retry_at = None
+            exc_type, exc_value, _ = sys.exc_info()
+            self.charge_info = error_message(exc_value)
+            self.charge_error_msg = error_message(exc_value)
+            logger.warning('Charge failed amount(%s) payer(%s):%s - %s', amount, self._payer_id, exc_type, exc_value)
+            metrics.incr('charge.failed', model=model)
+            self.charge_failed(e, **kwargs)
+        finally:
+            deferred = self.charge_deferred
+
+            def charge_saved():
                 self._unlock()
-                self.post_charge(**kwargs)
-        return self.is_charged
+                if not deferred:
+                    self.post_charge(**kwargs)
+            self._log_attempt(operation, amount, self._charge_error(), started)
+            with metrics.timer('charge.save', model=model):
+                self._save_charge_fields([] if deferred else self.CHARGE_FIELDS, charge_saved)
+        return self.is_charged or (not capture and self.is_authorized)
+
+    @classmethod
+    def charge_consolidated(cls, objs, **kwargs):
+        """
+        Charge `objs` of one payer with a single gateway charge of their combined amount.
+        Every valid object gets the shared charge_id and its own amount, hooks are called per object.
+        Objects must be locked and have their outcome buffer set by the caller, see ChargeableManager.
+        """
+        for obj in objs:
+            obj._charging = True
+        try:
+            cls._charge_consolidated(objs, **kwargs)
+        finally:
+            for obj in objs:
+                obj._charging = False
+                obj._cached_charge_amount = None
+
+    @classmethod
+    def _charge_consolidated(cls, objs, **kwargs):
+        metrics = get_metrics()
+        model = cls.__name__
+        started = default_timer()
+        valid = []
+        for obj in objs:
+            obj.charge_deferred = False
+            if obj.is_valid_for_charge(**kwargs):
+                valid.append(obj)
+            else:
+                obj._log_attempt('charge', None, obj.charge_info, started)
+        if len(valid) < len(objs):
+            metrics.incr('charge.validation_failed', len(objs) - len(valid), model=model)
+        if not valid:
+            return
+        objs = valid
+        payer = objs[0].payer
+        amounts = []
+
+        try:
+            for obj in objs:
+                obj.pre_charge(**kwargs)
+                amounts.append(obj._get_charge_amount())
+            total = sum(amounts)
+            logger.info('Charging payer(%s): %s for %s objects', payer.id, total, len(objs))
+            charge_id = None
+            if total >= app_settings.CHARGEABLE_STRIPE_MINIMUM_CHARGE_AMOUNT:
+                with metrics.timer('charge.gateway', model=model):
+                    charge = objs[0]._call_gateway(get_gateway().charge,
+                                                   amount=total,
+                                                   customer=payer.stripe_token,
+                                                   description=cls.get_consolidated_charge_description(objs),
+                                                   idempotency_key=cls._consolidated_idempotency_key(objs))
+                logger.info('Charged payer(%s): %s', payer.id, total)
+                charge_id = charge.id
+            charge_date = datetime.now()
+            for obj, amount in zip(objs, amounts):
+                obj.charge_id = charge_id
+                obj.charge_amount = amount
+                obj.charge_status = PAID
+                obj.charge_date = charge_date
+                obj.charge_retry_at = None
+                obj.charge_info = cls.CONSOLIDATED_CHARGE_INFO % len(objs)
+                obj.charge_succeeded(amount, **kwargs)
+            metrics.incr('charge.succeeded', len(objs), model=model)
+        except CircuitOpenError:
+            logger.warning('Charge deferred amount(%s) payer(%s): gateway circuit breaker is open', sum(amounts), payer.id)
+            for obj in objs:
+                obj.charge_deferred = True
+                obj.charge_error_msg = cls.DEFERRED_CHARGE_MSG
+            metrics.incr('charge.deferred', len(objs), model=model)
+        except StripeError as e:
+            exc_type, exc_value, _ = sys.exc_info()
+            logger.warning('Charge failed amount(%s) payer(%s):%s - %s', sum(amounts), payer.id, exc_type, exc_value)
+            charge_date = datetime.now()
+            for obj in objs:
+                obj.charge_status = FAILED
+                obj.charge_date = charge_date
+                if isinstance(e, cls.RETRIED_ERRORS):
+                    obj.schedule_retry()
+                else:
+                    obj.charge_retry_at = None
+                obj.charge_info = error_message(exc_value)
+                obj.charge_error_msg = error_message(exc_value)
+                obj.charge_failed(e, **kwargs)
+            metrics.incr('charge.failed', len(objs), model=model)
+        finally:
+            for obj in objs:
+                obj._log_attempt('charge', obj._cached_charge_amount, obj._charge_error(), started)
+                if obj.charge_deferred:
+                    obj._save_charge_fields([], lambda: None)
+                else:
+                    obj._save_charge_fields(obj.CHARGE_FIELDS, lambda obj=obj: obj.post_charge(**kwargs))
+
+    @classmethod
+    def get_consolidated_charge_description(cls, objs):
+        return 'Chargeable %s ids:%s' % (cls.__name__, ','.join(str(obj.id) for obj in objs))
+
+    @property
+    def is_consolidated(self):
+        """Whether other objects share this object's charge, found by charge_id since charge_info may be overwritten."""
+        if not self.charge_id:
+            return False
+        return type(self)._default_manager.filter(charge_id=self.charge_id).exclude(pk=self.pk).exists()
+
+    async def acharge(self, **kwargs):
+        """Async version of `charge()`, runs it on the shared executor."""
+        return await run_in_executor(self.charge, **kwargs)
 
     def is_valid_for_charge(self, **kwargs):
         try:
@@ -85,7 +325,7 @@ class Chargeable(models.Model):
             if not self.id:
                 self.charge_error_msg = 'Chargeable object %s must be saved before it can be charged' % self.__class__.__name__
                 raise ValidationError(self.charge_error_msg)
-            if self.get_charge_amount() > app_settings.CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT:
+            if self._get_charge_amount() > app_settings.CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT:
                 self.charge_error_msg = 'Cannot charge more than $%s' % (app_settings.CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT / 100.0)
                 raise ValidationError('%s %s: %s' % (self.__class__.__name__, self.id, self.charge_error_msg))
             if self.charge_id:
@@ -107,14 +347,29 @@ class Chargeable(models.Model):
                 self.charge_error_msg = '%s is not an active customer' % self.__class__.__name__
                 raise ValidationError('%s %s' % (self.id, self.charge_error_msg))
         except ValidationError as e:
-            logger.info("Validation failed for %s %s, payer %s: %s" % (self.__class__.__name__, self.id, self.payer.id, e.message))
+            logger.info("Validation failed for %s %s, payer %s: %s", self.__class__.__name__, self.id, self._payer_id, e)
             self.charge_status = VALIDATION_FAILED
-            self.charge_info = e.message
-            self.save()
-            self.validation_failed(e.message, **kwargs)
+            self.charge_info = message = error_message(e)
+            self._save_charge_fields(['charge_status', 'charge_info'], lambda: self.validation_failed(message, **kwargs))
             return False
         return True
 
+    def schedule_retry(self):
+        """Set charge_retry_at from CHARGEABLE_RETRY_SCHEDULE for the next retry, None once the schedule is used up."""
+        schedule = app_settings.CHARGEABLE_RETRY_SCHEDULE
+        if self.charge_retry_count < len(schedule):
+            self.charge_retry_at = datetime.now() + timedelta(seconds=schedule[self.charge_retry_count])
+        else:
+            self.charge_retry_at = None
+
+    def prepare_retry(self):
+        """Clear the outcome of the failed charge so the object passes charge validation again."""
+        self.charge_id = None
+        self.charge_amount = None
+        self.charge_info = None
+        self.charge_retry_at = None
+        self.charge_retry_count += 1
+
     def _validate_for_charge(self, **kwargs):
         raise ValidationError('_validate_for_charge method should be implemented on %s.' % self.__class__.__name__)
 
@@ -122,6 +377,20 @@ class Chargeable(models.Model):
         """Must return amount to charge, in cents."""
         raise NotImplementedError
 
+    @classmethod
+    def get_charge_amounts(cls, objs):
+        """Must return dict of pk to amount for `objs`. Override to compute a whole batch with one query."""
+        return dict((obj.pk, obj.get_charge_amount()) for obj in objs)
+
+    def _get_charge_amount(self):
+        """Amount is computed once and kept until `charge()` finishes, outside of it every call computes it again."""
+        if self._cached_charge_amount is not None:
+            return self._cached_charge_amount
+        amount = self.get_charge_amount()
+        if self._charging:
+            self._cached_charge_amount = amount
+        return amount
+
     def charged_display(self):
         """Dollars to cents for use anywhere a human needs to see it"""
         return round(self.charge_amount / 100.0, 2) if self.charge_amount else 0.0
@@ -138,39 +407,227 @@ class Chargeable(models.Model):
     def charge_succeeded(self, charge_amount, **kwargs):
         pass
 
+    def charge_authorized(self, charge_amount, **kwargs):
+        pass
+
     def charge_failed(self, exc, **kwargs):
         pass
 
     def validation_failed(self, message, **kwargs):
         pass
 
+    def _idempotency_key(self, operation):
+        """
+        Same for every attempt of `operation` until the object is prepared for a retry, so an attempt repeated
+        after an ambiguous error, a crash or a rolled back batch can not charge twice.
+        Refunds may legitimately repeat (partial refunds), their keys are unique per attempt.
+        """
+        if operation == 'refund':
+            return 'chargeable-refund-%s-%s-%s' % (self._meta.label, self.pk, uuid.uuid4().hex)
+        return 'chargeable-%s-%s-%s-%s' % (operation, self._meta.label, self.pk, self.charge_retry_count)
+
+    @classmethod
+    def _consolidated_idempotency_key(cls, objs):
+        """Deterministic like `_idempotency_key()`, for the set of objects charged together."""
+        attempts = ','.join('%s-%s' % (obj.pk, obj.charge_retry_count) for obj in sorted(objs, key=lambda obj: obj.pk))
+        return 'chargeable-consolidated-%s-%s' % (cls._meta.label, hashlib.sha1(attempts.encode('utf-8')).hexdigest())
+
+    def _call_gateway(self, func, *args, **kwargs):
+        breaker = get_circuit_breaker()
+        if breaker is not None:
+            func = partial(breaker.call, func)
+        if self._scheduler is not None:
+            return self._scheduler.call(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    def _charge_error(self):
+        if self.charge_deferred:
+            return self.charge_error_msg
+        return self.charge_info if self.charge_status == FAILED else None
+
+    def _log_attempt(self, operation, amount, error, started):
+        if app_settings.CHARGEABLE_ATTEMPT_LOG:
+            get_attempt_log().add(self, operation, amount, error, default_timer() - started)
+
+    def charge_attempts(self):
+        """Logged charge and refund attempts of this object, oldest first."""
+        return ChargeAttempt.objects.filter(model=self._meta.label, object_id=str(self.pk)).order_by('created', 'pk')
+
+    def _save_charge_fields(self, fields, callback):
+        """Save only `fields` (or buffer them in bulk mode), then call `callback`. Unsaved objects are not written."""
+        if self.pk is None:
+            fields = []
+        if self._outcome_buffer is not None:
+            self._outcome_buffer.add(self, fields, callback)
+            return
+        if fields:
+            rollup.write(type(self), [self], lambda: self.save(update_fields=fields))
+        callback()
+
     def _lock(self):
-        return cache.add(self._lock_key, 1, app_settings.CHARGEABLE_CHARGE_LOCK_TIME)
+        if self._lock_held:
+            return True
+        return get_lock_backend().acquire(self._lock_key)
 
     def _unlock(self):
-        cache.delete(self._lock_key)
+        if self._lock_held:
+            return
+        get_lock_backend().release(self._lock_key)
 
     def refund(self, amount=None, reason=None, **kwargs):
-        if self.is_valid_for_refund(amount, **kwargs) and self._lock():
-            stripe.api_key = settings.STRIPE_API_KEY
-            try:
-                logger.info('Refunding payer(%s): %s, %s' % (self.payer.id, amount, reason))
-                charge = stripe.Charge.retrieve(self.charge_id)
-                charge.refund(amount=amount, reason=reason)
-                self.charge_status = REFUNDED if charge.refunded else PARTIALLY_REFUNDED
-                self.refund_succeeded(amount, **kwargs)
-                return True
-            except StripeError as e:
-                exc_type, exc_value, _ = sys.exc_info()
-                self.refund_error_msg = exc_value.message
-                logger.warning('Refund failed amount(%s) payer(%s):%s - %s' % (amount, self.payer.id, exc_type, exc_value))
-                self.refund_failed(e, **kwargs)
-                return False
-            finally:
-                self.save()
+        metrics = get_metrics()
+        model = self.__class__.__name__
+        started = default_timer()
+        with metrics.timer('refund.validate', model=model):
+            is_valid = self.is_valid_for_refund(amount, **kwargs)
+        if not is_valid:
+            metrics.incr('refund.validation_failed', model=model)
+            self._log_attempt('refund', amount, self.refund_error_msg, started)
+            return False
+        with metrics.timer('refund.lock', model=model):
+            is_locked = self._lock()
+        if not is_locked:
+            metrics.incr('refund.lock_skipped', model=model)
+            return False
+
+        fields = []
+        try:
+            refund_amount = amount
+            # Full refund sends this object's amount, a consolidated charge is shared with other objects.
+            # After a partial refund the remainder is left to the gateway unless the charge is shared.
+            if amount is None and (self.charge_status == PAID or self.is_consolidated):
+                refund_amount = self.charge_amount
+            logger.info('Refunding payer(%s): %s, %s', self._payer_id, refund_amount, reason)
+            with metrics.timer('refund.gateway', model=model):
+                charge = self._call_gateway(get_gateway().refund, self.charge_id, amount=refund_amount,
+                                            reason=reason, idempotency_key=self._idempotency_key('refund'))
+            self.charge_status = REFUNDED if charge.refunded or amount is None else PARTIALLY_REFUNDED
+            fields = ['charge_status']
+            metrics.incr('refund.succeeded', model=model)
+            self.refund_succeeded(amount, **kwargs)
+            return True
+        except StripeError as e:
+            exc_type, exc_value, _ = sys.exc_info()
+            self.refund_error_msg = error_message(exc_value)
+            logger.warning('Refund failed amount(%s) payer(%s):%s - %s', amount, self._payer_id, exc_type, exc_value)
+            metrics.incr('refund.failed', model=model)
+            self.refund_failed(e, **kwargs)
+            return False
+        finally:
+            def refund_saved():
                 self._unlock()
                 self.post_refund(amount, **kwargs)
-        return False
+            self._log_attempt('refund', amount, None if fields else self.refund_error_msg, started)
+            with metrics.timer('refund.save', model=model):
+                self._save_charge_fields(fields, refund_saved)
+
+    def capture(self, amount=None, **kwargs):
+        """
+        Capture `amount` (all by default) of an AUTHORIZED object, which becomes PAID. When the capture fails the object
+        stays AUTHORIZED with its charge_id and the error in charge_info, to be captured again or released later.
+        """
+        metrics = get_metrics()
+        model = self.__class__.__name__
+        started = default_timer()
+        if not self.is_valid_for_capture(amount):
+            metrics.incr('capture.validation_failed', model=model)
+            return False
+        with metrics.timer('capture.lock', model=model):
+            is_locked = self._lock()
+        if not is_locked:
+            metrics.incr('capture.lock_skipped', model=model)
+            return False
+
+        self.charge_deferred = False
+        fields = []
+        error = None
+        try:
+            with metrics.timer('capture.gateway', model=model):
+                self._call_gateway(get_gateway().capture, self.charge_id, amount=amount,
+                                   idempotency_key=self._idempotency_key('capture'))
+            logger.info('Captured payer(%s): %s', self._payer_id, amount or self.charge_amount)
+            if amount is not None:
+                self.charge_amount = amount
+            self.charge_status = PAID
+            self.charge_date = datetime.now()
+            fields = self.CHARGE_FIELDS
+            metrics.incr('capture.succeeded', model=model)
+            self.charge_succeeded(self.charge_amount, **kwargs)
+        except CircuitOpenError:
+            self.charge_deferred = True
+            self.charge_error_msg = self.DEFERRED_CHARGE_MSG
+            logger.warning('Capture deferred payer(%s): gateway circuit breaker is open', self._payer_id)
+            metrics.incr('capture.deferred', model=model)
+        except StripeError as e:
+            # not FAILED: retry_many() would charge again and leave the authorization neither captured nor released
+            exc_type, exc_value, _ = sys.exc_info()
+            self.charge_info = error = error_message(exc_value)
+            self.charge_error_msg = error_message(exc_value)
+            fields = ['charge_info']
+            logger.warning('Capture failed amount(%s) payer(%s):%s - %s', amount, self._payer_id, exc_type, exc_value)
+            metrics.incr('capture.failed', model=model)
+            self.charge_failed(e, **kwargs)
+        finally:
+            def capture_saved():
+                self._unlock()
+                if fields:
+                    self.post_charge(**kwargs)
+            self._log_attempt('capture', amount or self.charge_amount, self.charge_error_msg if self.charge_deferred else error,
+                              started)
+            with metrics.timer('capture.save', model=model):
+                self._save_charge_fields(fields, capture_saved)
+        return self.is_charged
+
+    def release(self, **kwargs):
+        """Cancel authorization of an AUTHORIZED object, it becomes REFUNDED without having been captured."""
+        metrics = get_metrics()
+        model = self.__class__.__name__
+        started = default_timer()
+        if not self.is_valid_for_capture():
+            metrics.incr('release.validation_failed', model=model)
+            return False
+        if not self._lock():
+            metrics.incr('release.lock_skipped', model=model)
+            return False
+
+        fields = []
+        try:
+            with metrics.timer('release.gateway', model=model):
+                self._call_gateway(get_gateway().release, self.charge_id, idempotency_key=self._idempotency_key('release'))
+            logger.info('Released authorization payer(%s): %s', self._payer_id, self.charge_amount)
+            self.charge_status = REFUNDED
+            self.charge_info = self.RELEASED_CHARGE_INFO
+            fields = ['charge_status', 'charge_info']
+            metrics.incr('release.succeeded', model=model)
+        except StripeError:
+            exc_type, exc_value, _ = sys.exc_info()
+            self.charge_error_msg = error_message(exc_value)
+            logger.warning('Release failed payer(%s):%s - %s', self._payer_id, exc_type, exc_value)
+            metrics.incr('release.failed', model=model)
+        finally:
+            self._log_attempt('release', self.charge_amount, None if fields else self.charge_error_msg, started)
+            self._save_charge_fields(fields, self._unlock)
+        return bool(fields)
+
+    def is_valid_for_capture(self, amount=None):
+        try:
+            if self.charge_status != AUTHORIZED:
+                self.charge_error_msg = 'Cannot capture Chargeable with status "%s"' % self.get_charge_status_display()
+                raise ValidationError(self.charge_error_msg)
+            if not self.charge_id:
+                self.charge_error_msg = 'Cannot capture Chargeable with charge_id not set'
+                raise ValidationError(self.charge_error_msg)
+            if amount is not None and not 0 < amount <= self.charge_amount:
+                self.charge_error_msg = 'Cannot capture %s of %s authorized' % (amount, self.charge_amount)
+                raise ValidationError(self.charge_error_msg)
+        except ValidationError as e:
+            logger.info("Validation failed on capture for %s %s, payer %s: %s", self.__class__.__name__, self.id, self._payer_id, e)
+            return False
+        return True
+
+    async def arefund(self, amount=None, reason=None, **kwargs):
+        """Async version of `refund()`, runs it on the shared executor."""
+        return await run_in_executor(self.refund, amount=amount, reason=reason, **kwargs)
 
     def is_valid_for_refund(self, amount=None, **kwargs):
         try:
@@ -190,7 +647,7 @@ class Chargeable(models.Model):
                 self.refund_error_msg = 'Cannot refund Chargeable with charge_id not set'
                 raise ValidationError(self.refund_error_msg)
         except ValidationError as e:
-            logger.info("Validation failed on refund for %s %s, payer %s: %s" % (self.__class__.__name__, self.id, self.payer.id, e.message))
+            logger.info("Validation failed on refund for %s %s, payer %s: %s", self.__class__.__name__, self.id, self._payer_id, e)
             return False
         return True
 
@@ -203,13 +660,81 @@ class Chargeable(models.Model):
     def refund_failed(self, e, **kwargs):
         pass
 
-    def admin_refund_link(self):
-        from chargeable.choices import PAID, PARTIALLY_REFUNDED
-        from django.core.urlresolvers import reverse
+    @classmethod
+    def admin_refund_url(cls, pk):
+        """URL of admin refund popup, the URL pattern is reversed only once per model."""
+        key = get_script_prefix(), cls._meta.label
+        if key not in _admin_refund_urls:
+            name = 'admin:%s_%s_refund' % (cls._meta.app_label, cls._meta.model_name)
+            _admin_refund_urls[key] = reverse(name, args=(ADMIN_URL_PK,))
+        return _admin_refund_urls[key].replace(ADMIN_URL_PK, str(pk))
 
+    def admin_refund_link(self):
         if self.charge_status in [PAID, PARTIALLY_REFUNDED]:
-            url = reverse('admin:%s_%s_refund' % (self._meta.app_label, self._meta.model_name), args=(self.id,))
-            return '<a href="%s?_popup=1" onclick="return showAddAnotherPopup(this);"><b>Refund</b></a>' % url
+            return format_html('<a href="{}?_popup=1" onclick="return showAddAnotherPopup(this);"><b>Refund</b></a>',
+                               self.admin_refund_url(self.pk))
         return ''
-    admin_refund_link.allow_tags = True
-    admin_refund_link.short_description = 'Refund'
\ No newline at end of file
+    admin_refund_link.short_description = 'Refund'
+
+
+class ChargeRollup(models.Model):
+    """Number and charge_amount sum of objects per Chargeable model, day of charge_date and charge_status."""
+    model = models.CharField(max_length=100)
+    day = models.DateField()
+    charge_status = models.IntegerField(choices=CHARGEABLE_STATUS_CHOICES)
+    total_count = models.BigIntegerField(default=0)
+    total_amount = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('model', 'day', 'charge_status')
+
+    def __str__(self):
+        return '%s %s %s' % (self.model, self.day, self.get_charge_status_display())
+
+
+class ChargeAttempt(models.Model):
+    """Append-only record of a charge or refund attempt of a Chargeable object, see CHARGEABLE_ATTEMPT_LOG."""
+    OPERATION_CHOICES = (
+        ('charge', 'Charge'),
+        ('authorize', 'Authorize'),
+        ('capture', 'Capture'),
+        ('release', 'Release'),
+        ('refund', 'Refund'),
+    )
+
+    model = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=64)
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    # Status of the object after the attempt
+    charge_status = models.IntegerField(choices=CHARGEABLE_STATUS_CHOICES)
+    amount = models.IntegerField(null=True, blank=True)
+    charge_id = models.CharField(max_length=32, blank=True, null=True)
+    error = models.CharField(max_length=255, null=True, blank=True)
+    # Seconds from validation to the outcome
+    duration = models.FloatField(null=True, blank=True)
+    created = models.DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'object_id', 'created']),
+        ]
+
+    def __str__(self):
+        return '%s %s %s %s' % (self.operation, self.model, self.object_id, self.get_charge_status_display())
+
+
+class WebhookEvent(models.Model):
+    """Stripe event stored before the webhook is acknowledged, `applied` is set once its status change is written."""
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created = models.DateTimeField(default=datetime.now)
+    applied = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['applied', 'created']),
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.event_type, self.event_id)
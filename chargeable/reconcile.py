@@ -0,0 +1,184 @@
+import csv
+import heapq
+import json
+from itertools import groupby
+
+from django.db import connections
+from chargeable.choices import *
+from chargeable.exceptions import ReconciliationError
+from chargeable.utils import chunked
+
+
+MISSING_LOCAL = 'missing_local'
+MISSING_REMOTE = 'missing_remote'
+AMOUNT_DRIFT = 'amount_drift'
+STATUS_DRIFT = 'status_drift'
+
+
+def captured_amount(charge):
+    """Amount local objects of gateway `charge` must add up to: the captured amount, the authorized one until captured."""
+    if not charge.get('captured', True) or charge.get('amount_captured') is None:
+        return int(charge.get('amount') or 0)
+    return int(charge['amount_captured'])
+
+
+def expected_statuses(charge, objects_count=1):
+    """
+    Local statuses that agree with gateway `charge` (dict with status, refunded, amount_refunded, disputed,
+    and optionally captured and amount_captured).
+    """
+    if charge.get('status') == 'failed':
+        return {FAILED}
+    if charge.get('disputed'):
+        return {DISPUTED}
+    if charge.get('refunded'):
+        return {REFUNDED}
+    if not charge.get('captured', True):
+        return {AUTHORIZED}
+    # the part left uncaptured by a partial capture is reported as refunded, it is not a refund
+    uncaptured = int(charge.get('amount') or 0) - captured_amount(charge)
+    if int(charge.get('amount_refunded') or 0) > uncaptured:
+        # refunds of a consolidated charge are done per object
+        return {PARTIALLY_REFUNDED, REFUNDED, PAID} if objects_count > 1 else {PARTIALLY_REFUNDED}
+    return {PAID}
+
+
+def ordered(rows, side):
+    """Pass `rows` through, making sure they come sorted by charge id."""
+    last = None
+    for row in rows:
+        if last is not None and row[0] < last:
+            raise ReconciliationError('%s charges are not sorted by id: %s after %s' % (side, row[0], last))
+        last = row[0]
+        yield row
+
+
+def as_querysets(querysets):
+    return list(querysets) if isinstance(querysets, (list, tuple)) else [querysets]
+
+
+def object_key(queryset, pk, labelled):
+    """Key objects are reported by: pk, or 'app_label.Model:pk' when several models are reconciled at once."""
+    return '%s:%s' % (queryset.model._meta.label, pk) if labelled else pk
+
+
+def local_charges(querysets, chunk_size=2000):
+    """
+    Yield (charge_id, [(object, amount, status), ...]) from `querysets` sorted by charge_id with server side cursors.
+    Give a queryset of every model charged through the gateway account, `object` is the pk or, with several
+    querysets, see `object_key()`. Objects sharing a consolidated charge come together.
+    """
+    querysets = as_querysets(querysets)
+    streams = [sorted_rows(queryset, chunk_size, len(querysets) > 1) for queryset in querysets]
+    rows = heapq.merge(*streams, key=lambda row: row[0])
+    for charge_id, group in groupby(rows, key=lambda row: row[0]):
+        yield charge_id, [row[1:] for row in group]
+
+
+def sorted_rows(queryset, chunk_size, labelled=False):
+    """Yield (charge_id, object, amount, status) of charged objects of `queryset` sorted by charge_id."""
+    queryset = queryset.exclude(charge_id__isnull=True).exclude(charge_id='')
+    order = 'charge_id'
+    if connections[queryset.db].vendor == 'postgresql':
+        # merge join compares ids the way Python does, locale collation would not
+        from django.db.models.functions import Collate
+        order = Collate('charge_id', 'C')
+    rows = queryset.order_by(order).values_list('charge_id', 'pk', 'charge_amount', 'charge_status')
+    for charge_id, pk, amount, status in ordered(rows.iterator(chunk_size=chunk_size), 'Local'):
+        yield charge_id, object_key(queryset, pk, labelled), amount, status
+
+
+def remote_charges_from_file(path):
+    """
+    Yield (charge_id, charge dict) from a JSON lines or CSV file sorted by charge id.
+    Every record needs `id`, `amount` (cents) and `status`,
+    and may have `refunded`, `amount_refunded`, `disputed`, `captured` and `amount_captured`.
+    """
+    with open(path) as f:
+        if path.endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for charge_id, record in ordered(((record['id'], record) for record in records), 'Remote'):
+            yield charge_id, normalize(record)
+
+
+def normalize(record):
+    def flag(value):
+        return value in (True, 1) or str(value).lower() in ('true', '1', 'yes')
+    return {
+        'amount': int(record.get('amount') or 0),
+        'amount_refunded': int(record.get('amount_refunded') or 0),
+        'status': record.get('status'),
+        'refunded': flag(record.get('refunded')),
+        'disputed': flag(record.get('disputed')) or bool(record.get('dispute')),
+        'captured': flag(record.get('captured', True)),
+        'amount_captured': None if record.get('amount_captured') in (None, '') else int(record['amount_captured']),
+    }
+
+
+def remote_charges_from_gateway(gateway):
+    """Yield (charge_id, charge dict) for every charge listed by `gateway`, newest first."""
+    for charge in gateway.list_charges():
+        yield charge['id'], normalize(charge)
+
+
+def compare(charge_id, objects, charge):
+    """Yield mismatches between local `objects` of one charge and gateway `charge`."""
+    local_amount = sum(amount or 0 for _, amount, _ in objects)
+    remote_amount = captured_amount(charge)
+    if local_amount != remote_amount:
+        yield {'type': AMOUNT_DRIFT, 'charge_id': charge_id, 'local_amount': local_amount,
+               'remote_amount': remote_amount, 'objects': [pk for pk, _, _ in objects]}
+    statuses = expected_statuses(charge, len(objects))
+    for pk, _, status in objects:
+        if status not in statuses:
+            yield {'type': STATUS_DRIFT, 'charge_id': charge_id, 'object': pk, 'local_status': status,
+                   'remote_status': charge['status'], 'expected_statuses': sorted(statuses)}
+
+
+def is_missing(charge):
+    """Whether gateway `charge` without local objects is a mismatch, `charge()` keeps no charge id of failed attempts."""
+    return charge.get('status') != 'failed'
+
+
+def merge_join(local, remote):
+    """Merge two charge streams sorted by charge id and yield every mismatch."""
+    local, remote = iter(local), iter(remote)
+    local_item, remote_item = next(local, None), next(remote, None)
+    while local_item is not None or remote_item is not None:
+        if remote_item is None or (local_item is not None and local_item[0] < remote_item[0]):
+            yield {'type': MISSING_REMOTE, 'charge_id': local_item[0], 'objects': [pk for pk, _, _ in local_item[1]]}
+            local_item = next(local, None)
+        elif local_item is None or remote_item[0] < local_item[0]:
+            if is_missing(remote_item[1]):
+                yield {'type': MISSING_LOCAL, 'charge_id': remote_item[0],
+                       'remote_amount': captured_amount(remote_item[1])}
+            remote_item = next(remote, None)
+        else:
+            for mismatch in compare(local_item[0], local_item[1], remote_item[1]):
+                yield mismatch
+            local_item, remote_item = next(local, None), next(remote, None)
+
+
+def lookup_join(querysets, remote, batch_size=1000):
+    """
+    Compare unsorted `remote` charges with `querysets` (see `local_charges()`) looking up every batch of ids
+    with one query per queryset. Charges missing on the gateway side can not be found this way.
+    """
+    querysets = as_querysets(querysets)
+    for batch in chunked(remote, batch_size):
+        objects = {}
+        for queryset in querysets:
+            rows = queryset.filter(charge_id__in=[charge_id for charge_id, _ in batch])\
+                .values_list('charge_id', 'pk', 'charge_amount', 'charge_status')
+            for charge_id, pk, amount, status in rows:
+                objects.setdefault(charge_id, []).append((object_key(queryset, pk, len(querysets) > 1), amount, status))
+        for charge_id, charge in batch:
+            if charge_id not in objects:
+                if not is_missing(charge):
+                    continue
+                yield {'type': MISSING_LOCAL, 'charge_id': charge_id, 'remote_amount': captured_amount(charge)}
+                continue
+            for mismatch in compare(charge_id, objects[charge_id], charge):
+                yield mismatch
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from chargeable import app_settings
+
+
+# Rollup state of objects loaded without all of charge_status, charge_date and charge_amount
+UNKNOWN = 'unknown'
+
+
+def bucket(obj):
+    """Return (day, status, amount) the object is counted in, or None when it has no charge_date."""
+    if obj.charge_date is None:
+        return None
+    day = obj.charge_date.date() if isinstance(obj.charge_date, datetime) else obj.charge_date
+    return day, obj.charge_status, obj.charge_amount or 0
+
+
+class RollupDeltas(object):
+    """Collects count and amount changes of rollup rows caused by status changes of objects."""
+
+    def __init__(self):
+        self.deltas = {}
+        self.objs = []
+
+    def add(self, obj):
+        previous, current = obj._rollup_state, bucket(obj)
+        if previous == UNKNOWN or previous == current:
+            return
+        label = obj._meta.label
+        if previous is not None:
+            self._change(label, previous, -1)
+        if current is not None:
+            self._change(label, current, 1)
+        self.objs.append((obj, current))
+
+    def _change(self, label, state, sign):
+        day, status, amount = state
+        delta = self.deltas.setdefault((label, day, status), [0, 0])
+        delta[0] += sign
+        delta[1] += sign * amount
+
+    def apply(self, using):
+        """Update rollup rows in key order, so concurrent transactions lock them in the same order."""
+        from chargeable.models import ChargeRollup
+
+        rows = ChargeRollup.objects.using(using)
+        for (label, day, status), (count, amount) in sorted(self.deltas.items()):
+            if not count and not amount:
+                continue
+            updates = {'total_count': F('total_count') + count, 'total_amount': F('total_amount') + amount}
+            if rows.filter(model=label, day=day, charge_status=status).update(**updates):
+                continue
+            try:
+                with transaction.atomic(using=using):
+                    rows.create(model=label, day=day, charge_status=status, total_count=count, total_amount=amount)
+            except IntegrityError:
+                # created by a concurrent transaction in the meantime
+                rows.filter(model=label, day=day, charge_status=status).update(**updates)
+
+    def commit(self):
+        for obj, current in self.objs:
+            obj._rollup_state = current
+
+
+def write(model, objs, func):
+    """
+    Call `func` writing `objs` of `model` and, when CHARGEABLE_ROLLUP is on,
+    update rollup rows for their status changes in the same transaction.
+    """
+    if not app_settings.CHARGEABLE_ROLLUP:
+        return func()
+    deltas = RollupDeltas()
+    for obj in objs:
+        deltas.add(obj)
+    if not deltas.deltas:
+        return func()
+    using = router.db_for_write(model)
+    with transaction.atomic(using=using):
+        result = func()
+        deltas.apply(using)
+    deltas.commit()
+    return result
+
+
+def rebuild(model):
+    """Replace rollup rows of `model` with totals computed from its table. Returns number of rows written."""
+    from django.db.models import Count, Sum
+    from django.db.models.functions import Coalesce, TruncDate
+    from chargeable.models import ChargeRollup
+
+    label = model._meta.label
+    using = router.db_for_write(model)
+    totals = model._default_manager.using(using).filter(charge_date__isnull=False)\
+        .annotate(day=TruncDate('charge_date'))\
+        .values('day', 'charge_status')\
+        .annotate(total_count=Count('pk'), total_amount=Coalesce(Sum('charge_amount'), 0))\
+        .order_by('day', 'charge_status')
+    with transaction.atomic(using=using):
+        ChargeRollup.objects.using(using).filter(model=label).delete()
+        rows = ChargeRollup.objects.using(using).bulk_create(
+            [ChargeRollup(model=label, **row) for row in totals.iterator()],
+            batch_size=app_settings.CHARGEABLE_BULK_UPDATE_BATCH_SIZE
+        )
+    return len(rows)
@@ -0,0 +1,223 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from django.core.cache import caches
+from stripe.error import APIConnectionError, APIError, RateLimitError
+from chargeable import app_settings
+from chargeable.exceptions import CircuitOpenError
+
+
+logger = logging.getLogger('chargeable')
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError)
+# Errors telling the gateway is unhealthy, card declines and invalid requests are not
+OUTAGE_ERRORS = (APIConnectionError, APIError)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return process wide scheduler shared by all bulk and worker charges."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ChargeScheduler()
+    return _scheduler
+
+
+def get_circuit_breaker():
+    """Return process wide circuit breaker, None unless CHARGEABLE_CIRCUIT_BREAKER is set."""
+    global _breaker
+    if not app_settings.CHARGEABLE_CIRCUIT_BREAKER:
+        return None
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker()
+    return _breaker
+
+
+class TokenBucket(object):
+    """Thread safe token bucket allowing `rate` calls per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        # at least one token, otherwise rates below 1 would never allow a call
+        self.capacity = max(1.0, float(capacity or rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CacheTokenBucket(object):
+    """
+    Allows `rate` calls per second across all processes sharing the cache.
+    Calls are counted with `cache.incr` in one second windows, or in windows of 1 / `rate` seconds
+    allowing one call when `rate` is below 1.
+    """
+
+    def __init__(self, rate, alias=None, key_prefix='chargeable_rate'):
+        self.rate = float(rate)
+        if self.rate <= 0:
+            raise ValueError('Rate must be positive, got %r' % rate)
+        self.window = max(1.0, 1 / self.rate)
+        self.limit = max(1, int(self.rate * self.window))
+        self.cache = caches[alias or app_settings.CHARGEABLE_LOCK_CACHE]
+        self.key_prefix = key_prefix
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            window = int(now // self.window)
+            key = '%s_%d' % (self.key_prefix, window)
+            self.cache.add(key, 0, int(self.window) + 2)
+            try:
+                count = self.cache.incr(key)
+            except ValueError:
+                # window expired between add and incr
+                continue
+            if count <= self.limit:
+                return
+            time.sleep((window + 1) * self.window - now)
+
+
+class ChargeScheduler(object):
+    """
+    Paces gateway calls with a token bucket and retries rate limit and connection errors
+    with exponential backoff and full jitter. Other errors are raised at once.
+    """
+
+    def __init__(self, rate=None, shared=None, max_retries=None, backoff=None, max_backoff=None):
+        rate = app_settings.CHARGEABLE_GATEWAY_RATE_LIMIT if rate is None else rate
+        shared = app_settings.CHARGEABLE_GATEWAY_RATE_LIMIT_SHARED if shared is None else shared
+        if not rate:
+            self.bucket = None
+        elif shared:
+            self.bucket = CacheTokenBucket(rate)
+        else:
+            self.bucket = TokenBucket(rate)
+        self.max_retries = app_settings.CHARGEABLE_GATEWAY_RETRIES if max_retries is None else max_retries
+        self.backoff = app_settings.CHARGEABLE_GATEWAY_BACKOFF if backoff is None else backoff
+        self.max_backoff = app_settings.CHARGEABLE_GATEWAY_MAX_BACKOFF if max_backoff is None else max_backoff
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+                logger.info('Gateway call failed with %s, retry %s in %.2fs', e.__class__.__name__, attempt, delay)
+                time.sleep(delay)
+
+    def max_delay(self, calls, concurrency):
+        """
+        Upper bound of seconds pacing and retries may add to `calls` gateway calls made on `concurrency` threads:
+        full backoff of every retry for each wave of concurrent calls, and the time the rate limit spreads calls over.
+        """
+        backoff = sum(min(self.max_backoff, self.backoff * 2 ** attempt) for attempt in range(self.max_retries))
+        delay = backoff * math.ceil(calls / float(max(1, concurrency)))
+        if self.bucket is not None:
+            delay += calls / self.bucket.rate
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Stops gateway calls of all processes sharing the cache while the gateway is failing.
+    Calls raising OUTAGE_ERRORS, or taking longer than `slow_call` seconds, are failures. Once at least `min_calls`
+    calls of a `window` seconds long window were made and `error_rate` of them failed the circuit opens:
+    calls raise CircuitOpenError at once for `cooldown` seconds. After that one call at a time is let through
+    as a probe, the circuit closes when a probe succeeds and stays open for another cooldown when it fails.
+    """
+
+    def __init__(self, error_rate=None, slow_call=None, min_calls=None, window=None, cooldown=None,
+                 alias=None, key_prefix='chargeable_breaker'):
+        self.error_rate = app_settings.CHARGEABLE_BREAKER_ERROR_RATE if error_rate is None else error_rate
+        self.slow_call = app_settings.CHARGEABLE_BREAKER_SLOW_CALL if slow_call is None else slow_call
+        self.min_calls = app_settings.CHARGEABLE_BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.window = window or app_settings.CHARGEABLE_BREAKER_WINDOW
+        self.cooldown = cooldown or app_settings.CHARGEABLE_BREAKER_COOLDOWN
+        self.cache = caches[alias or app_settings.CHARGEABLE_LOCK_CACHE]
+        self.key_prefix = key_prefix
+
+    def _key(self, name):
+        return '%s_%s' % (self.key_prefix, name)
+
+    def is_open(self):
+        """True while calls are refused, probes are not counted."""
+        return self.cache.get(self._key('cooldown')) is not None
+
+    def call(self, func, *args, **kwargs):
+        state = self.cache.get_many([self._key('open'), self._key('cooldown')])
+        probe = self._key('open') in state
+        if probe and (self._key('cooldown') in state or not self.cache.add(self._key('probe'), 1, self.cooldown)):
+            raise CircuitOpenError('Gateway circuit breaker is open, call was not made')
+
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except OUTAGE_ERRORS:
+            self._record(False, probe)
+            raise
+        except Exception:
+            self._record(True, probe)
+            raise
+        self._record(not self.slow_call or time.time() - start <= self.slow_call, probe)
+        return result
+
+    def _record(self, succeeded, probe):
+        window = int(time.time() // self.window)
+        calls_key, failures_key = self._key('calls_%d' % window), self._key('failures_%d' % window)
+        if probe:
+            if succeeded:
+                self.cache.delete_many([self._key('open'), self._key('probe'), calls_key, failures_key])
+                logger.warning('Gateway circuit breaker closed')
+            else:
+                self._open()
+            return
+
+        calls = self._incr(calls_key)
+        if succeeded:
+            return
+        failures = self._incr(failures_key)
+        if calls >= self.min_calls and failures >= self.error_rate * calls:
+            self._open()
+
+    def _incr(self, key):
+        self.cache.add(key, 0, self.window * 2)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            self.cache.add(key, 1, self.window * 2)
+            return 1
+
+    def _open(self):
+        self.cache.set(self._key('cooldown'), 1, self.cooldown)
+        # open marker outlives the cooldown, it is removed by a successful probe
+        self.cache.set(self._key('open'), time.time(), None)
+        self.cache.delete(self._key('probe'))
+        logger.warning('Gateway circuit breaker opened for %ss', self.cooldown)
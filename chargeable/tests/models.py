@@ -1,4 +1,5 @@
 from decimal import Decimal
+from django.db import models
 from chargeable.models import Chargeable
 
 
@@ -9,12 +10,17 @@ class Payer(object):
 
 
 class RealChargeable(Chargeable):
-    id = 1
     payer = Payer()
     _charge_amount = 1000  # $10.00
 
-    class Meta:
-        abstract = True
+    class Meta(Chargeable.Meta):
+        # Not an installed app, the model has no table and is never migrated
+        app_label = 'chargeable_tests'
+
+    def __init__(self, *args, **kwargs):
+        if not args:
+            kwargs.setdefault('id', 1)
+        super(RealChargeable, self).__init__(*args, **kwargs)
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
@@ -24,4 +30,33 @@ class RealChargeable(Chargeable):
         pass
 
     def get_charge_amount(self):
-        return self._charge_amount
\ No newline at end of file
+        return self._charge_amount
+
+
+class Customer(models.Model):
+    stripe_token = models.CharField(max_length=32, blank=True, null=True)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        app_label = 'chargeable_tests'
+
+
+class Order(Chargeable):
+    """Chargeable with a table, created by tests that need one, see DatabaseTestCase."""
+    customer = models.ForeignKey(Customer, null=True, on_delete=models.SET_NULL)
+    amount = models.IntegerField(default=1000)
+
+    payer_field = 'customer'
+
+    class Meta(Chargeable.Meta):
+        app_label = 'chargeable_tests'
+
+    @property
+    def payer(self):
+        return self.customer
+
+    def _validate_for_charge(self, **kwargs):
+        pass
+
+    def get_charge_amount(self):
+        return self.amount
@@ -1,14 +1,56 @@
 from decimal import Decimal
 import datetime
+import os
+import signal
 from chargeable.app_settings import CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT
+from django.conf import settings
 from django.core.cache import cache
-from django.test import TestCase
-from mock import Mock, patch
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, TestCase
+from mock import ANY, Mock, PropertyMock, patch
 from stripe import StripeError
+from stripe.error import APIConnectionError, CardError, RateLimitError
+from chargeable.admin import ChargeableAdmin, get_job_progress, is_job_lost, new_job_progress, run_job
 from chargeable.choices import *
-from chargeable.exceptions import ValidationError
-from chargeable.models import Chargeable
-from chargeable.tests.models import RealChargeable
+from chargeable.buffers import AttemptLog
+from chargeable.exceptions import CircuitOpenError, ValidationError
+from chargeable.gateways import SimulatedGateway
+from chargeable.locks import CacheLockBackend, PostgresAdvisoryLockBackend, RedisLockBackend
+from chargeable.management.commands.chargeable_capture import Command as CaptureCommand
+from chargeable.management.commands.chargeable_retry import Command as RetryCommand
+from chargeable.management.commands.chargeable_worker import Command as WorkerCommand
+from chargeable.managers import ChargeableManager
+from chargeable.metrics import InMemoryMetrics
+from chargeable.models import Chargeable, ChargeRollup, WebhookEvent, _admin_refund_urls
+from chargeable import rollup
+from chargeable.rollup import RollupDeltas
+from chargeable.reconcile import (compare, expected_statuses, local_charges, lookup_join, merge_join, normalize,
+                                  AMOUNT_DRIFT, MISSING_LOCAL, MISSING_REMOTE, STATUS_DRIFT)
+from chargeable.scheduler import CacheTokenBucket, ChargeScheduler, CircuitBreaker, TokenBucket
+from chargeable.tests.models import Customer, Order, RealChargeable
+from chargeable.utils import run_in_executor
+from chargeable.webhooks import EventBuffer, apply_events, apply_pending, get_status_update, stripe_webhook
+
+
+class DatabaseTestCase(TestCase):
+    """Creates tables of the test models, which belong to no installed app and are never migrated."""
+    models = (Customer, Order)
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            for model in cls.models:
+                editor.create_model(model)
+        super(DatabaseTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(DatabaseTestCase, cls).tearDownClass()
+        with connection.schema_editor() as editor:
+            for model in reversed(cls.models):
+                editor.delete_model(model)
 
 
 class TestChargeValidation(TestCase):
@@ -100,11 +142,11 @@ class TestRefundValidation(TestCase):
 class TestAmount(TestCase):
 
     def setUp(self):
-        self.chargeable = Chargeable()
         self.real_chargeable = RealChargeable()
 
     def test_get_charge_amount_raises_error(self):
-        self.assertRaises(NotImplementedError, self.chargeable.get_charge_amount)
+        # Chargeable is abstract, call its implementation on a concrete subclass
+        self.assertRaises(NotImplementedError, Chargeable.get_charge_amount, self.real_chargeable)
 
     def test_get_charge_amount_gives_integer(self):
         got = self.real_chargeable.get_charge_amount()
@@ -112,7 +154,7 @@ class TestAmount(TestCase):
         self.assertIsInstance(got, int)
 
 
-def mocked_charge(amount, customer, currency, description):
+def mocked_charge(amount, customer, currency, description, **kwargs):
     return type('obj', (object,), {'id': 'asd', 'amount': amount})
 
 
@@ -176,7 +218,7 @@ class TestCharge(TestCase):
         self.chargeable.charge()
 
         self.chargeable.post_charge.assert_called_once_with()
-        self.chargeable.save.assert_called_once_with()
+        self.chargeable.save.assert_called_once_with(update_fields=Chargeable.CHARGE_FIELDS)
 
     def test_cannot_charge_more_than_max_amount(self):
         self.chargeable._charge_amount = CHARGEABLE_STRIPE_MAXIMUM_CHARGE_AMOUNT + 1
@@ -201,4 +243,1250 @@ class TestCharge(TestCase):
     def test_chargeable_unlocked_after_charge(self):
         self.assertTrue(self.chargeable.charge())
 
-        self.assertFalse(cache.has_key(self.chargeable._lock_key))
\ No newline at end of file
+        self.assertFalse(cache.has_key(self.chargeable._lock_key))
+
+    @patch('chargeable.models.get_circuit_breaker')
+    def test_charge_deferred_when_circuit_open(self, get_circuit_breaker):
+        get_circuit_breaker.return_value.call.side_effect = CircuitOpenError('open')
+        self.chargeable.save = Mock()
+        self.chargeable.charge_failed = Mock()
+
+        self.assertFalse(self.chargeable.charge())
+
+        self.assertTrue(self.chargeable.charge_deferred)
+        self.assertEqual(self.chargeable.charge_status, NOT_PAID)
+        self.assertEqual(self.chargeable.save.call_count, 0)
+        self.assertEqual(self.chargeable.charge_failed.call_count, 0)
+        self.assertFalse(cache.has_key(self.chargeable._lock_key))
+
+    @patch('chargeable.app_settings.CHARGEABLE_ATTEMPT_LOG', True)
+    @patch('chargeable.models.get_attempt_log')
+    def test_attempt_logged(self, get_attempt_log):
+        self.chargeable.charge()
+
+        get_attempt_log.return_value.add.assert_called_once_with(self.chargeable, 'charge',
+                                                                 self.chargeable._charge_amount, None, ANY)
+
+
+class TestIdempotencyKey(TestCase):
+
+    def test_charge_key_kept_until_retry(self):
+        chargeable = RealChargeable(id=42)
+
+        self.assertEqual(chargeable._idempotency_key('charge'), 'chargeable-charge-chargeable_tests.RealChargeable-42-0')
+        self.assertEqual(chargeable._idempotency_key('charge'), chargeable._idempotency_key('charge'))
+        chargeable.prepare_retry()
+        self.assertEqual(chargeable._idempotency_key('charge'), 'chargeable-charge-chargeable_tests.RealChargeable-42-1')
+
+    def test_refund_keys_unique(self):
+        chargeable = RealChargeable()
+
+        self.assertNotEqual(chargeable._idempotency_key('refund'), chargeable._idempotency_key('refund'))
+
+    def test_consolidated_key_depends_on_objects(self):
+        objs = [RealChargeable(id=1), RealChargeable(id=2)]
+
+        key = RealChargeable._consolidated_idempotency_key(objs)
+
+        self.assertEqual(key, RealChargeable._consolidated_idempotency_key(list(reversed(objs))))
+        self.assertNotEqual(key, RealChargeable._consolidated_idempotency_key(objs[:1]))
+
+
+class TestRetry(TestCase):
+
+    def setUp(self):
+        self.chargeable = RealChargeable()
+
+    def seconds_to_retry(self):
+        return (self.chargeable.charge_retry_at - datetime.datetime.now()).total_seconds()
+
+    @patch('chargeable.app_settings.CHARGEABLE_RETRY_SCHEDULE', [60, 600])
+    def test_retries_follow_schedule(self):
+        self.chargeable.schedule_retry()
+        self.assertAlmostEqual(self.seconds_to_retry(), 60, delta=5)
+
+        self.chargeable.prepare_retry()
+        self.chargeable.schedule_retry()
+        self.assertAlmostEqual(self.seconds_to_retry(), 600, delta=5)
+
+        self.chargeable.prepare_retry()
+        self.chargeable.schedule_retry()
+        self.assertIsNone(self.chargeable.charge_retry_at)
+
+    @patch('stripe.Charge.create')
+    def test_failed_charge_can_be_retried(self, create):
+        create.side_effect = CardError('declined', None, 'card_declined')
+        self.chargeable.charge()
+        self.assertEqual(self.chargeable.charge_status, FAILED)
+        self.assertIsNotNone(self.chargeable.charge_retry_at)
+
+        create.side_effect = mocked_charge
+        self.chargeable.prepare_retry()
+
+        self.assertTrue(self.chargeable.charge())
+        self.assertEqual(self.chargeable.charge_retry_count, 1)
+        self.assertIsNone(self.chargeable.charge_retry_at)
+        self.assertIsNone(self.chargeable.charge_info)
+
+    @patch('stripe.Charge.create')
+    def test_ambiguous_failures_not_retried(self, create):
+        for error in (APIConnectionError('timeout'), StripeError('server error')):
+            create.side_effect = error
+            self.chargeable.charge()
+
+            self.assertEqual(self.chargeable.charge_status, FAILED)
+            self.assertIsNone(self.chargeable.charge_retry_at)
+
+
+class TestAuthorization(TestCase):
+
+    def setUp(self):
+        self.chargeable = RealChargeable()
+        self.gateway = SimulatedGateway(latency=0, failure_rate=0)
+        self.patcher = patch('chargeable.models.get_gateway', return_value=self.gateway)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @patch('stripe.Charge.create')
+    def test_authorize_does_not_capture(self, create):
+        self.patcher.stop()
+        create.side_effect = mocked_charge
+
+        self.assertTrue(self.chargeable.authorize())
+
+        self.assertEqual(create.call_args[1]['capture'], False)
+        self.assertEqual(self.chargeable.charge_status, AUTHORIZED)
+        self.assertFalse(self.chargeable.is_charged)
+        self.patcher.start()
+
+    def test_capture_makes_authorized_paid(self):
+        self.chargeable.authorize()
+        self.chargeable.charge_succeeded = Mock()
+
+        self.assertTrue(self.chargeable.capture(amount=600))
+
+        self.assertEqual(self.chargeable.charge_status, PAID)
+        self.assertEqual(self.chargeable.charge_amount, 600)
+        self.chargeable.charge_succeeded.assert_called_once_with(600)
+
+    def test_cannot_capture_more_than_authorized_or_twice(self):
+        self.chargeable.authorize()
+
+        self.assertFalse(self.chargeable.is_valid_for_capture(amount=self.chargeable.charge_amount + 1))
+        self.assertTrue(self.chargeable.capture())
+        self.assertFalse(self.chargeable.capture())
+
+    def test_failed_capture_keeps_authorization(self):
+        self.chargeable.authorize()
+        charge_id = self.chargeable.charge_id
+
+        with patch.object(self.gateway, 'capture', side_effect=StripeError('Charge has expired')):
+            self.assertFalse(self.chargeable.capture())
+
+        self.assertEqual(self.chargeable.charge_status, AUTHORIZED)
+        self.assertEqual(self.chargeable.charge_id, charge_id)
+        self.assertEqual(self.chargeable.charge_info, 'Charge has expired')
+        self.assertIsNone(self.chargeable.charge_retry_at)
+        self.assertTrue(self.chargeable.release())
+
+    def test_release(self):
+        self.chargeable.authorize()
+
+        self.assertTrue(self.chargeable.release())
+
+        self.assertEqual(self.chargeable.charge_status, REFUNDED)
+        self.assertEqual(self.chargeable.charge_info, Chargeable.RELEASED_CHARGE_INFO)
+
+
+class TestChargeCandidates(DatabaseTestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(stripe_token='cus_1')
+
+    def order(self, customer=None, **kwargs):
+        return Order.objects.create(customer=customer or self.customer, **kwargs)
+
+    def status_and_info(self, order):
+        order.refresh_from_db()
+        return order.charge_status, order.charge_info
+
+    def test_already_charged_rejected(self):
+        with_charge_id = self.order(charge_id='ch_1')
+        with_amount = self.order(charge_amount=1000)
+
+        self.assertEqual(list(Order.objects.charge_candidates()), [])
+
+        for order in (with_charge_id, with_amount):
+            self.assertEqual(self.status_and_info(order), (VALIDATION_FAILED, 'Order has already been charged'))
+
+    def test_payers_checked_in_sql(self):
+        without_payer = Order.objects.create()
+        without_token = self.order(Customer.objects.create(stripe_token=None))
+        empty_token = self.order(Customer.objects.create(stripe_token=''))
+        inactive = self.order(Customer.objects.create(stripe_token='cus_2', is_active=False))
+
+        self.assertEqual(list(Order.objects.charge_candidates()), [])
+
+        for order in (without_payer, without_token, empty_token):
+            self.assertEqual(self.status_and_info(order),
+                             (VALIDATION_FAILED, 'Order does not belong to active customer'))
+        self.assertEqual(self.status_and_info(inactive), (VALIDATION_FAILED, 'Order is not an active customer'))
+
+    def test_returns_valid_due_objects(self):
+        valid = self.order()
+        paid = self.order(charge_status=PAID, charge_id='ch_1', charge_amount=1000)
+        self.order(charge_id='ch_2')
+
+        self.assertEqual(list(Order.objects.charge_candidates(Order.objects.all())), [valid])
+        self.assertEqual(self.status_and_info(paid), (PAID, None))
+
+    def test_payers_loaded_with_candidates(self):
+        self.order()
+        self.order(Customer.objects.create(stripe_token='cus_2'))
+
+        # one UPDATE per rejection reason and one SELECT of candidates with their payers
+        with self.assertNumQueries(4):
+            candidates = list(Order.objects.charge_candidates())
+            self.assertTrue(all(order.is_valid_for_charge() for order in candidates))
+        self.assertEqual(len(candidates), 2)
+
+    def test_payerless_object_fails_validation(self):
+        order = Order.objects.create()
+
+        self.assertFalse(order.charge())
+
+        self.assertEqual(self.status_and_info(order),
+                         (VALIDATION_FAILED, '%s Order does not belong to active customer' % order.pk))
+
+    def test_unsaved_object_fails_validation(self):
+        order = Order(customer=self.customer)
+        order.validation_failed = Mock()
+
+        self.assertFalse(order.charge())
+
+        self.assertEqual(order.charge_status, VALIDATION_FAILED)
+        self.assertIsNone(order.pk)
+        self.assertFalse(Order.objects.exists())
+        order.validation_failed.assert_called_once_with('Chargeable object Order must be saved before it can be charged')
+
+    def test_payerless_object_fails_capture_and_refund_validation(self):
+        order = Order.objects.create(charge_status=NOT_PAID)
+
+        self.assertFalse(order.is_valid_for_capture())
+        self.assertFalse(order.is_valid_for_refund())
+
+
+class TestWorker(DatabaseTestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(stripe_token='cus_1')
+        self.command = WorkerCommand()
+        self.command.concurrency = 1
+        self.signal_handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        self.patcher = patch('chargeable.models.get_gateway', return_value=SimulatedGateway(latency=0, failure_rate=0))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        signal.signal(signal.SIGTERM, self.signal_handlers[0])
+        signal.signal(signal.SIGINT, self.signal_handlers[1])
+
+    def create(self, count, **kwargs):
+        return [Order.objects.create(customer=self.customer, **kwargs) for _ in range(count)]
+
+    def run_worker(self, **options):
+        options = dict({'models': [], 'batch_size': 10, 'concurrency': 1, 'sleep': 0, 'prevalidate': False,
+                        'once': True}, **options)
+        with patch.object(WorkerCommand, 'get_models', return_value=[Order]):
+            self.command.handle(**options)
+
+    def test_batch_claimed_charged_and_released(self):
+        orders = self.create(3)
+
+        self.assertEqual(self.command.process_batch(Order, 2), 2)
+
+        statuses = dict(Order.objects.values_list('pk', 'charge_status'))
+        self.assertEqual(statuses, {orders[0].pk: PAID, orders[1].pk: PAID, orders[2].pk: NOT_PAID})
+        self.assertFalse(Order.objects.filter(charge_claimed_until__isnull=False).exists())
+
+    def test_objects_claimed_while_charged(self):
+        self.create(2)
+        claimed = []
+
+        def charge_many(objs, **kwargs):
+            claimed.append(Order.objects.filter(charge_claimed_until__gt=datetime.datetime.now()).count())
+            Order.objects.filter(pk__in=[obj.pk for obj in objs]).update(charge_status=PAID)
+            return {'deferred': [], 'lock_skipped': []}
+
+        with patch.object(ChargeableManager, 'charge_many', side_effect=charge_many):
+            self.command.process_batch(Order, 10)
+
+        self.assertEqual(claimed, [2])
+        self.assertFalse(Order.objects.filter(charge_claimed_until__isnull=False).exists())
+
+    def test_claimed_objects_skipped_until_claim_runs_out(self):
+        now = datetime.datetime.now()
+        claimed = self.create(1, charge_claimed_until=now + datetime.timedelta(minutes=5))[0]
+        expired = self.create(1, charge_claimed_until=now - datetime.timedelta(minutes=5))[0]
+
+        self.assertEqual(self.command.process_batch(Order, 10), 1)
+
+        self.assertEqual(Order.objects.get(pk=claimed.pk).charge_status, NOT_PAID)
+        self.assertEqual(Order.objects.get(pk=expired.pk).charge_status, PAID)
+
+    def test_outcome_kept_when_hook_fails(self):
+        orders = self.create(2)
+
+        with patch.object(Order, 'post_charge', side_effect=RuntimeError('hook failed')):
+            self.assertEqual(self.command.process_batch(Order, 10), 2)
+
+        for order in orders:
+            order.refresh_from_db()
+            self.assertEqual(order.charge_status, PAID)
+            self.assertTrue(order.charge_id)
+            self.assertIsNone(order.charge_claimed_until)
+
+    def test_claim_released_when_batch_raises(self):
+        self.create(1)
+
+        with patch.object(ChargeableManager, 'charge_many', side_effect=DatabaseError('gone')):
+            with self.assertRaises(DatabaseError):
+                self.command.process_batch(Order, 10)
+
+        self.assertFalse(Order.objects.filter(charge_claimed_until__isnull=False).exists())
+
+    def test_deferred_objects_not_counted(self):
+        self.create(2)
+        breaker = Mock(**{'call.side_effect': CircuitOpenError()})
+
+        with patch('chargeable.models.get_circuit_breaker', return_value=breaker):
+            self.assertEqual(self.command.process_batch(Order, 10), 0)
+
+        self.assertEqual(Order.objects.filter(charge_status=NOT_PAID, charge_claimed_until__isnull=True).count(), 2)
+
+    def test_objects_locked_elsewhere_not_counted(self):
+        order = self.create(1)[0]
+        self.assertTrue(order._lock())
+
+        self.assertEqual(self.command.process_batch(Order, 10), 0)
+
+        order._unlock()
+        self.assertEqual(Order.objects.get(pk=order.pk).charge_status, NOT_PAID)
+
+    def test_errored_objects_keep_claim(self):
+        orders = self.create(2)
+
+        with patch.object(Order, 'pre_charge', side_effect=RuntimeError('hook failed')):
+            self.assertEqual(self.command.process_batch(Order, 10), 0)
+            self.assertEqual(self.command.process_batch(Order, 10), 0)
+
+        for order in orders:
+            order.refresh_from_db()
+            self.assertEqual(order.charge_status, NOT_PAID)
+            self.assertGreater(order.charge_claimed_until, datetime.datetime.now())
+
+    def test_once_exits_when_only_errored_objects_are_due(self):
+        self.create(2)
+
+        with patch.object(Order, 'pre_charge', side_effect=RuntimeError('hook failed')), \
+                patch.object(WorkerCommand, 'claim', wraps=self.command.claim) as claim:
+            self.run_worker()
+
+        self.assertEqual(claim.call_count, 1)
+
+    def test_once_exits_when_nothing_is_due(self):
+        self.create(5)
+
+        with patch.object(WorkerCommand, 'process_batch', side_effect=[3, 2, 0]) as process_batch:
+            self.run_worker(batch_size=3)
+
+        self.assertEqual([c[0][1] for c in process_batch.call_args_list], [3, 3, 3])
+
+    def test_once_charges_everything_due(self):
+        self.create(5)
+
+        self.run_worker(batch_size=2)
+
+        self.assertEqual(Order.objects.filter(charge_status=PAID).count(), 5)
+
+    def test_failed_releases_not_counted(self):
+        old = datetime.datetime.now() - datetime.timedelta(days=30)
+        orders = self.create(2, charge_status=AUTHORIZED, charge_id='ch_auth', charge_amount=1000, charge_date=old)
+        command = CaptureCommand()
+        command.concurrency = 1
+
+        with patch.object(Order.objects, 'due_for_capture', return_value=Order.objects.none()), \
+                patch.object(SimulatedGateway, 'release', side_effect=StripeError('Charge has expired')) as release:
+            self.assertEqual(command.process_batch(Order, 10), 0)
+            self.assertEqual(command.process_batch(Order, 10), 0)
+
+        self.assertEqual(release.call_count, 2)
+        for order in orders:
+            order.refresh_from_db()
+            self.assertEqual(order.charge_status, AUTHORIZED)
+            self.assertGreater(order.charge_claimed_until, datetime.datetime.now())
+
+    def test_prevalidate_only_offered_by_charge_worker(self):
+        parser = WorkerCommand().create_parser('manage.py', 'chargeable_worker')
+        self.assertTrue(parser.parse_args(['--prevalidate']).prevalidate)
+
+        for command in (RetryCommand(), CaptureCommand()):
+            parser = command.create_parser('manage.py', 'command')
+            self.assertFalse(hasattr(parser.parse_args([]), 'prevalidate'))
+            with self.assertRaises(CommandError):
+                parser.parse_args(['--prevalidate'])
+
+    def test_sigterm_stops_after_current_batch(self):
+        def process_batch(model, batch_size):
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 1
+
+        with patch.object(WorkerCommand, 'process_batch', side_effect=process_batch) as mock:
+            self.run_worker(once=False)
+
+        self.assertEqual(mock.call_count, 1)
+        self.assertTrue(self.command.stopping)
+
+
+class TestChargeMany(TestCase):
+
+    def setUp(self):
+        self.patcher = patch('stripe.Charge.create')
+        self.mocked_stripe = self.patcher.start()
+        self.mocked_stripe.side_effect = mocked_charge
+        # RealChargeable has no table, outcomes are written through its default manager
+        self.manager_patcher = patch.object(ChargeableManager, 'bulk_update')
+        self.bulk_update = self.manager_patcher.start()
+        self.manager = ChargeableManager()
+
+        self.chargeables = []
+        for i in range(1, 6):
+            chargeable = RealChargeable()
+            chargeable.id = i
+            self.chargeables.append(chargeable)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.manager_patcher.stop()
+
+    def test_all_charged(self):
+        results = self.manager.charge_many(self.chargeables, concurrency=3, batch_size=2)
+
+        self.assertEqual(sorted(c.id for c in results['charged']), [1, 2, 3, 4, 5])
+        self.assertEqual(self.mocked_stripe.call_count, 5)
+
+    def test_results_split_by_outcome(self):
+        self.chargeables[0]._validate_for_charge = Mock(side_effect=ValidationError('test'))
+        self.assertTrue(self.chargeables[1]._lock())
+
+        results = self.manager.charge_many(self.chargeables, concurrency=2)
+
+        self.assertEqual(results['validation_failed'], [self.chargeables[0]])
+        self.assertEqual(results['lock_skipped'], [self.chargeables[1]])
+        self.assertEqual(len(results['charged']), 3)
+        self.chargeables[1]._unlock()
+
+    def test_batch_locked_for_every_wave_of_calls(self):
+        backend = Mock(**{'acquire_many.return_value': [True] * 5})
+        scheduler = ChargeScheduler(rate=None, max_retries=0)
+
+        with patch('chargeable.managers.get_lock_backend', return_value=backend), \
+                patch('chargeable.managers.get_scheduler', return_value=scheduler), \
+                patch('chargeable.app_settings.CHARGEABLE_CHARGE_LOCK_TIME', 60):
+            self.manager.charge_many(self.chargeables, concurrency=2, batch_size=5)
+
+        backend.acquire_many.assert_called_once_with([c._lock_key for c in self.chargeables], 180)
+        backend.release_many.assert_called_once_with([c._lock_key for c in self.chargeables])
+
+    def test_batch_lock_time_covers_pacing_and_backoff(self):
+        scheduler = ChargeScheduler(rate=10, max_retries=3, backoff=1, max_backoff=3)
+
+        with patch('chargeable.app_settings.CHARGEABLE_CHARGE_LOCK_TIME', 60):
+            # 3 waves of 8 calls, 60 + 6 seconds of backoff each, and 2 seconds of pacing
+            self.assertEqual(self.manager.batch_lock_time(20, 8, scheduler), 200)
+
+    def test_failing_amount_reported_for_its_object_only(self):
+        self.chargeables[2].get_charge_amount = Mock(side_effect=RuntimeError('no amount'))
+
+        results = self.manager.charge_many(self.chargeables, concurrency=2)
+
+        self.assertEqual(results['failed'], [self.chargeables[2]])
+        self.assertEqual(sorted(c.id for c in results['charged']), [1, 2, 4, 5])
+
+    def test_failing_amount_does_not_fail_payer_group(self):
+        self.chargeables[2].get_charge_amount = Mock(side_effect=RuntimeError('no amount'))
+
+        results = self.manager.charge_consolidated(self.chargeables, concurrency=2)
+
+        self.assertEqual(results['failed'], [self.chargeables[2]])
+        self.assertEqual(sorted(c.id for c in results['charged']), [1, 2, 4, 5])
+        self.assertEqual(self.mocked_stripe.call_count, 1)
+
+    def test_hooks_called_for_every_object(self):
+        for chargeable in self.chargeables:
+            chargeable.post_charge = Mock()
+
+        self.manager.charge_many(self.chargeables, concurrency=2, foo='bar')
+
+        for chargeable in self.chargeables:
+            chargeable.post_charge.assert_called_once_with(foo='bar')
+
+    @patch.object(ChargeableManager, 'due_for_charge', return_value=[])
+    def test_charges_due_objects_by_default(self, due_for_charge):
+        self.manager.charge_many()
+
+        due_for_charge.assert_called_once_with()
+
+    def test_failing_hook_does_not_stop_batch(self):
+        for chargeable in self.chargeables:
+            chargeable.post_charge = Mock()
+        self.chargeables[0].post_charge.side_effect = RuntimeError
+
+        results = self.manager.charge_many(self.chargeables, concurrency=2)
+
+        self.assertEqual(len(results['charged']), 5)
+        for chargeable in self.chargeables:
+            self.assertEqual(chargeable.post_charge.call_count, 1)
+
+    def test_batch_unlocked_after_charge(self):
+        self.manager.charge_many(self.chargeables, concurrency=2)
+
+        for chargeable in self.chargeables:
+            self.assertFalse(cache.has_key(chargeable._lock_key))
+
+    def test_charge_consolidated_charges_payer_once(self):
+        results = self.manager.charge_consolidated(self.chargeables, concurrency=2)
+
+        self.assertEqual(self.mocked_stripe.call_count, 1)
+        self.assertEqual(self.mocked_stripe.call_args[1]['amount'], 5 * RealChargeable._charge_amount)
+        self.assertEqual(len(results['charged']), 5)
+        for chargeable in self.chargeables:
+            self.assertEqual(chargeable.charge_id, 'asd')
+            self.assertEqual(chargeable.charge_amount, RealChargeable._charge_amount)
+            self.assertEqual(chargeable.charge_info, Chargeable.CONSOLIDATED_CHARGE_INFO % 5)
+
+    def test_outcomes_written_with_bulk_update(self):
+        for chargeable in self.chargeables:
+            chargeable.save = Mock()
+
+        self.manager.charge_many(self.chargeables, concurrency=2, batch_size=5)
+
+        self.bulk_update.assert_called_once_with(self.chargeables, tuple(Chargeable.CHARGE_FIELDS),
+                                                                 batch_size=500)
+        for chargeable in self.chargeables:
+            self.assertEqual(chargeable.save.call_count, 0)
+
+
+class TestAsyncCharge(TestCase):
+
+    def setUp(self):
+        self.patcher = patch('stripe.Charge.create')
+        self.mocked_stripe = self.patcher.start()
+        self.mocked_stripe.side_effect = mocked_charge
+
+        self.chargeable = RealChargeable()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_acharge_charges(self):
+        import asyncio
+
+        self.assertTrue(asyncio.run(self.chargeable.acharge()))
+
+        self.assertEqual(self.chargeable.charge_status, PAID)
+        self.assertEqual(self.mocked_stripe.call_count, 1)
+
+    def test_coroutine_bound_to_loop_when_awaited(self):
+        import asyncio
+
+        coroutine = run_in_executor(lambda: 42)
+
+        self.assertEqual(asyncio.run(coroutine), 42)
+
+
+class TestSimulatedGateway(TestCase):
+
+    def setUp(self):
+        self.chargeable = RealChargeable()
+
+    def test_charge_succeeds(self):
+        with patch('chargeable.models.get_gateway', return_value=SimulatedGateway(latency=0, failure_rate=0)):
+            self.assertTrue(self.chargeable.charge())
+
+        self.assertTrue(self.chargeable.charge_id.startswith('ch_sim_'))
+        self.assertEqual(self.chargeable.charge_amount, self.chargeable._charge_amount)
+
+    def test_charge_fails_with_failure_rate(self):
+        with patch('chargeable.models.get_gateway', return_value=SimulatedGateway(latency=0, failure_rate=1)):
+            self.assertFalse(self.chargeable.charge())
+
+        self.assertEqual(self.chargeable.charge_status, FAILED)
+
+
+class TestChargeAmounts(TestCase):
+
+    def setUp(self):
+        self.patcher = patch('stripe.Charge.create')
+        self.mocked_stripe = self.patcher.start()
+        self.mocked_stripe.side_effect = mocked_charge
+
+        self.chargeable = RealChargeable()
+        self.chargeable.get_charge_amount = Mock(return_value=1000)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_amount_computed_once_per_charge(self):
+        self.chargeable.charge()
+
+        self.assertEqual(self.chargeable.get_charge_amount.call_count, 1)
+        self.assertIsNone(self.chargeable._cached_charge_amount)
+
+    def test_amount_not_kept_after_validation_alone(self):
+        self.assertTrue(self.chargeable.is_valid_for_charge())
+        self.chargeable.get_charge_amount.return_value = 2500
+
+        self.chargeable.charge()
+
+        self.assertEqual(self.chargeable.charge_amount, 2500)
+
+    def test_primed_amount_used(self):
+        with patch.object(RealChargeable, 'get_charge_amounts', return_value={1: 700}) as get_charge_amounts:
+            ChargeableManager().prime_charge_amounts([self.chargeable])
+
+        get_charge_amounts.assert_called_once_with([self.chargeable])
+        self.chargeable.charge()
+
+        self.assertEqual(self.chargeable.charge_amount, 700)
+        self.assertEqual(self.chargeable.get_charge_amount.call_count, 0)
+
+
+class TestChargeScheduler(TestCase):
+
+    def setUp(self):
+        self.scheduler = ChargeScheduler(rate=None, max_retries=2, backoff=0, max_backoff=0)
+
+    def test_rate_limit_errors_are_retried(self):
+        func = Mock(side_effect=[RateLimitError('slow down'), 'charge'])
+
+        self.assertEqual(self.scheduler.call(func, amount=100), 'charge')
+        self.assertEqual(func.call_count, 2)
+        func.assert_called_with(amount=100)
+
+    def test_gives_up_after_max_retries(self):
+        func = Mock(side_effect=RateLimitError('slow down'))
+
+        self.assertRaises(RateLimitError, self.scheduler.call, func)
+        self.assertEqual(func.call_count, 3)
+
+    def test_card_errors_are_not_retried(self):
+        func = Mock(side_effect=CardError('declined', None, 'card_declined'))
+
+        self.assertRaises(CardError, self.scheduler.call, func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_token_bucket_paces_calls(self):
+        with patch('chargeable.scheduler.time') as mocked_time:
+            mocked_time.time.return_value = 100.0
+            mocked_time.sleep.side_effect = lambda seconds: setattr(mocked_time.time, 'return_value', 100.5)
+            bucket = TokenBucket(rate=10, capacity=1)
+
+            bucket.acquire()
+            self.assertEqual(mocked_time.sleep.call_count, 0)
+            bucket.acquire()
+
+        mocked_time.sleep.assert_called_once_with(0.1)
+
+    def test_shared_bucket_allows_fractional_rate(self):
+        with patch('chargeable.scheduler.time') as mocked_time:
+            mocked_time.time.return_value = 1000.0
+            mocked_time.sleep.side_effect = lambda seconds: setattr(mocked_time.time, 'return_value', 1004.0)
+            bucket = CacheTokenBucket(rate=0.25, key_prefix='test_fractional_rate')
+
+            bucket.acquire()
+            self.assertEqual(mocked_time.sleep.call_count, 0)
+            bucket.acquire()
+
+        mocked_time.sleep.assert_called_once_with(4.0)
+        self.assertRaises(ValueError, CacheTokenBucket, 0)
+
+    def test_token_bucket_allows_fractional_rate(self):
+        with patch('chargeable.scheduler.time') as mocked_time:
+            mocked_time.time.return_value = 100.0
+            mocked_time.sleep.side_effect = lambda seconds: setattr(mocked_time.time, 'return_value', 104.0)
+            bucket = TokenBucket(rate=0.25)
+
+            bucket.acquire()
+            bucket.acquire()
+
+        mocked_time.sleep.assert_called_once_with(4.0)
+
+
+class TestLockBackends(TestCase):
+
+    def test_cache_locks_expire_after_timeout(self):
+        backend = CacheLockBackend(timeout=60)
+        backend.cache = Mock(**{'add.side_effect': [True, False, True]})
+
+        self.assertEqual(backend.acquire_many(['a', 'b']), [True, False])
+        self.assertTrue(backend.acquire('c', timeout=600))
+
+        self.assertEqual(backend.cache.add.call_args_list, [(('a', 1, 60),), (('b', 1, 60),), (('c', 1, 600),)])
+
+    def test_redis_batch_locked_with_one_pipeline(self):
+        redis = Mock()
+        client = redis.StrictRedis.from_url.return_value
+        pipeline = client.pipeline.return_value
+        pipeline.execute.return_value = [True, None]
+
+        with patch.dict('sys.modules', {'redis': redis}):
+            backend = RedisLockBackend(url='redis://test', timeout=60)
+        acquired = backend.acquire_many(['a', 'b'], timeout=600)
+
+        self.assertEqual(acquired, [True, False])
+        redis.StrictRedis.from_url.assert_called_once_with('redis://test')
+        self.assertEqual(pipeline.set.call_args_list, [(('a', backend.token), {'nx': True, 'ex': 600}),
+                                                       (('b', backend.token), {'nx': True, 'ex': 600})])
+        self.assertEqual(pipeline.execute.call_count, 1)
+
+    def test_redis_releases_only_own_locks(self):
+        redis = Mock()
+        pipeline = redis.StrictRedis.from_url.return_value.pipeline.return_value
+
+        with patch.dict('sys.modules', {'redis': redis}):
+            backend = RedisLockBackend(url='redis://test')
+        backend.release_many(['a', 'b'])
+
+        self.assertEqual(backend.release_lock.call_args_list, [
+            ({'keys': ['a'], 'args': [backend.token], 'client': pipeline},),
+            ({'keys': ['b'], 'args': [backend.token], 'client': pipeline},),
+        ])
+        self.assertEqual(pipeline.execute.call_count, 1)
+        self.assertEqual(backend.acquire_many([]), [])
+        backend.release_many([])
+        self.assertEqual(pipeline.execute.call_count, 1)
+
+    def test_postgres_batch_locked_with_one_query(self):
+        backend = PostgresAdvisoryLockBackend(alias='default')
+        with patch('chargeable.locks.connections') as connections:
+            cursor = connections.__getitem__.return_value.cursor.return_value.__enter__.return_value
+            cursor.fetchall.return_value = [(True,), (False,)]
+
+            self.assertEqual(backend.acquire_many(['a', 'b'], timeout=600), [True, False])
+            backend.release_many(['a'])
+
+        connections.__getitem__.assert_called_with('default')
+        (acquire_sql, acquire_params), (release_sql, release_params) = [c[0] for c in cursor.execute.call_args_list]
+        self.assertIn('pg_try_advisory_lock', acquire_sql)
+        self.assertEqual(acquire_params, [[backend.lock_id('a'), backend.lock_id('b')]])
+        self.assertIn('pg_advisory_unlock', release_sql)
+        self.assertEqual(release_params, [[backend.lock_id('a')]])
+
+    def test_postgres_lock_ids_are_stable_bigints(self):
+        backend = PostgresAdvisoryLockBackend(alias='default')
+
+        self.assertEqual(backend.lock_id('chargeable-1'), backend.lock_id('chargeable-1'))
+        self.assertNotEqual(backend.lock_id('chargeable-1'), backend.lock_id('chargeable-2'))
+        self.assertTrue(-2 ** 63 <= backend.lock_id('chargeable-1') < 2 ** 63)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.patcher = patch('stripe.Charge.create')
+        self.mocked_stripe = self.patcher.start()
+        self.mocked_stripe.side_effect = mocked_charge
+        self.metrics = InMemoryMetrics()
+        self.metrics_patcher = patch('chargeable.models.get_metrics', return_value=self.metrics)
+        self.metrics_patcher.start()
+
+        self.chargeable = RealChargeable()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.metrics_patcher.stop()
+
+    def test_charge_phases_timed(self):
+        self.chargeable.charge()
+
+        for phase in ['charge.validate', 'charge.lock', 'charge.gateway', 'charge.save']:
+            self.assertEqual(len(self.metrics.timings[phase]), 1)
+        self.assertEqual(self.metrics.counters['charge.succeeded'], 1)
+
+    def test_failed_charge_counted(self):
+        self.mocked_stripe.side_effect = StripeError
+
+        self.chargeable.charge()
+
+        self.assertEqual(self.metrics.counters['charge.failed'], 1)
+        self.assertEqual(self.metrics.counters['charge.succeeded'], 0)
+
+
+def mocked_refund(charge, amount=None, **kwargs):
+    refunded_charge = type('obj', (object,), {'id': charge, 'refunded': amount is None})
+    return type('obj', (object,), {'id': 're_asd', 'amount': amount, 'charge': refunded_charge})
+
+
+class TestRefund(TestCase):
+
+    def setUp(self):
+        self.patcher = patch('stripe.Refund.create')
+        self.mocked_stripe = self.patcher.start()
+        self.mocked_stripe.side_effect = mocked_refund
+        self.manager_patcher = patch.object(ChargeableManager, 'bulk_update')
+        self.manager_patcher.start()
+
+        self.chargeables = []
+        for i in range(1, 4):
+            chargeable = RealChargeable()
+            chargeable.id = i
+            chargeable.charge_id = 'ch_%s' % i
+            chargeable.charge_amount = 1000
+            chargeable.charge_status = PAID
+            self.chargeables.append(chargeable)
+        self.chargeable = self.chargeables[0]
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.manager_patcher.stop()
+
+    def test_full_refund_is_one_api_call(self):
+        self.chargeable.save = Mock()
+
+        self.assertTrue(self.chargeable.refund())
+
+        self.assertEqual(self.mocked_stripe.call_count, 1)
+        self.assertEqual(self.chargeable.charge_status, REFUNDED)
+        self.chargeable.save.assert_called_once_with(update_fields=['charge_status'])
+
+    def test_partial_refund(self):
+        self.assertTrue(self.chargeable.refund(amount=500))
+
+        self.assertEqual(self.chargeable.charge_status, PARTIALLY_REFUNDED)
+
+    def test_full_refund_refunds_own_amount(self):
+        # a consolidated charge may be shared even though webhooks overwrote charge_info
+        self.chargeable.charge_info = 'Dispute won'
+
+        self.assertTrue(self.chargeable.refund())
+
+        self.assertEqual(self.mocked_stripe.call_args[1]['amount'], 1000)
+        self.assertEqual(self.chargeable.charge_status, REFUNDED)
+
+    def test_full_refund_after_partial_refund(self):
+        self.chargeable.charge_status = PARTIALLY_REFUNDED
+
+        with patch.object(RealChargeable, 'is_consolidated', new_callable=PropertyMock) as is_consolidated:
+            is_consolidated.return_value = False
+            self.assertTrue(self.chargeable.refund())
+            is_consolidated.return_value = True
+            self.chargeable.charge_status = PARTIALLY_REFUNDED
+            self.assertTrue(self.chargeable.refund())
+
+        self.assertEqual([call[1]['amount'] for call in self.mocked_stripe.call_args_list], [None, 1000])
+        self.assertEqual(self.chargeable.charge_status, REFUNDED)
+
+    def test_failed_refund_not_saved(self):
+        self.mocked_stripe.side_effect = StripeError
+        self.chargeable.save = Mock()
+
+        self.assertFalse(self.chargeable.refund())
+
+        self.assertEqual(self.chargeable.save.call_count, 0)
+        self.assertEqual(self.chargeable.charge_status, PAID)
+
+    def test_refund_many(self):
+        self.chargeables[2].charge_status = NOT_PAID
+
+        results = ChargeableManager().refund_many(self.chargeables, reason='duplicate', concurrency=2)
+
+        self.assertEqual(results['refunded'], self.chargeables[:2])
+        self.assertEqual(results['validation_failed'], [self.chargeables[2]])
+        self.mocked_stripe.assert_any_call(charge='ch_1', amount=1000, reason='duplicate', expand=['charge'],
+                                           api_key=settings.STRIPE_API_KEY, idempotency_key=ANY)
+
+    def test_refund_many_requires_queryset(self):
+        with self.assertRaises(TypeError):
+            ChargeableManager().refund_many()
+        self.assertEqual(self.mocked_stripe.call_count, 0)
+
+
+def stripe_event(event_id, event_type, **obj):
+    return {'id': event_id, 'type': event_type, 'created': 1, 'data': {'object': obj}}
+
+
+class TestWebhooks(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.patcher = patch('chargeable.webhooks.apply_events', return_value=0)
+        self.apply_events = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_status_updates(self):
+        self.assertEqual(get_status_update(stripe_event('evt_1', 'charge.refunded', id='ch_1', refunded=True))[:2],
+                         ('ch_1', REFUNDED))
+        self.assertEqual(get_status_update(stripe_event('evt_2', 'charge.refunded', id='ch_1', refunded=False))[:2],
+                         ('ch_1', PARTIALLY_REFUNDED))
+        self.assertEqual(get_status_update(stripe_event('evt_3', 'charge.dispute.created', charge='ch_1'))[:2],
+                         ('ch_1', DISPUTED))
+        self.assertIsNone(get_status_update(stripe_event('evt_4', 'customer.created', id='cus_1')))
+
+    def test_events_applied_in_batches(self):
+        buffer = EventBuffer(batch_size=2, max_delay=60)
+        first = stripe_event('evt_1', 'charge.refunded', id='ch_1', refunded=True)
+        second = stripe_event('evt_2', 'charge.refunded', id='ch_2', refunded=True)
+
+        buffer.add(first)
+        self.assertEqual(self.apply_events.call_count, 0)
+        buffer.add(second)
+
+        self.apply_events.assert_called_once_with([first, second])
+
+    def test_duplicate_events_dropped(self):
+        buffer = EventBuffer(batch_size=1)
+        event = stripe_event('evt_1', 'charge.refunded', id='ch_1', refunded=True)
+
+        self.assertTrue(buffer.add(event))
+        self.assertFalse(buffer.add(dict(event)))
+
+        self.assertEqual(self.apply_events.call_count, 1)
+
+    def test_failed_batch_stays_stored(self):
+        buffer = EventBuffer(batch_size=1)
+        event = stripe_event('evt_1', 'charge.refunded', id='ch_1', refunded=True)
+        self.apply_events.side_effect = DatabaseError
+
+        self.assertTrue(buffer.add(event))
+        self.assertEqual(WebhookEvent.objects.get(event_id='evt_1').applied, None)
+
+        self.apply_events.side_effect = None
+        self.assertEqual(apply_pending(), 1)
+        self.apply_events.assert_called_with([event])
+        self.assertIsNotNone(WebhookEvent.objects.get(event_id='evt_1').applied)
+        self.assertEqual(apply_pending(), 0)
+
+    @patch('chargeable.app_settings.CHARGEABLE_WEBHOOK_SECRET', None)
+    def test_secret_required(self):
+        request = RequestFactory().post('/stripe/webhook/', data='{}', content_type='application/json')
+
+        self.assertRaises(ImproperlyConfigured, stripe_webhook, request)
+
+
+class TestApplyEvents(DatabaseTestCase):
+
+    def setUp(self):
+        self.patcher = patch('chargeable.webhooks.apps.get_models', return_value=[Order])
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def apply(self, status, event):
+        order = Order.objects.create(charge_id='ch_1', charge_status=status, charge_amount=1000)
+        apply_events([event])
+        order.refresh_from_db()
+        return order.charge_status
+
+    def test_events_applied(self):
+        self.assertEqual(self.apply(AUTHORIZED, stripe_event('evt_1', 'charge.captured', id='ch_1')), PAID)
+        Order.objects.all().delete()
+        self.assertEqual(self.apply(PAID, stripe_event('evt_2', 'charge.refunded', id='ch_1', refunded=True)), REFUNDED)
+
+    def test_refunded_objects_never_become_paid(self):
+        won = stripe_event('evt_1', 'charge.dispute.closed', charge='ch_1', status='won')
+        captured = stripe_event('evt_2', 'charge.captured', id='ch_1')
+
+        self.assertEqual(self.apply(PARTIALLY_REFUNDED, won), PARTIALLY_REFUNDED)
+        Order.objects.all().delete()
+        self.assertEqual(self.apply(REFUNDED, captured), REFUNDED)
+
+    def test_paid_objects_never_fail(self):
+        self.assertEqual(self.apply(PAID, stripe_event('evt_1', 'charge.expired', id='ch_1')), PAID)
+
+
+class TestReport(DatabaseTestCase):
+
+    def setUp(self):
+        self.customer = Customer.objects.create(stripe_token='cus_1')
+
+    def create(self, status, day, amount):
+        return Order.objects.create(customer=self.customer, charge_status=status, charge_amount=amount,
+                                    charge_date=datetime.datetime(2020, 1, day, 12))
+
+    def charge(self, count, failure_rate=0):
+        orders = [Order.objects.create(customer=self.customer) for _ in range(count)]
+        with patch('chargeable.models.get_gateway', return_value=SimulatedGateway(latency=0, failure_rate=failure_rate)):
+            for order in orders:
+                order.charge()
+        return orders
+
+    def test_unknown_period(self):
+        with self.assertRaises(ValueError):
+            ChargeableManager().report(period='month')
+
+    def test_report_by_day_and_status(self):
+        self.create(PAID, 1, 1000)
+        self.create(PAID, 1, 500)
+        self.create(REFUNDED, 1, 300)
+        self.create(PAID, 2, 700)
+        Order.objects.create(customer=self.customer)
+
+        self.assertEqual(list(Order.objects.report()), [
+            {'period': datetime.date(2020, 1, 1), 'charge_status': PAID, 'count': 2, 'amount': 1500},
+            {'period': datetime.date(2020, 1, 1), 'charge_status': REFUNDED, 'count': 1, 'amount': 300},
+            {'period': datetime.date(2020, 1, 2), 'charge_status': PAID, 'count': 1, 'amount': 700},
+        ])
+        self.assertEqual([row['amount'] for row in Order.objects.revenue(period='week')], [2200])
+
+    def test_failed_charges_reported(self):
+        self.charge(2, failure_rate=1)
+
+        failures = list(Order.objects.failures())
+
+        self.assertEqual(failures, [{'period': datetime.date.today(), 'count': 2, 'amount': 0}])
+
+    @patch('chargeable.app_settings.CHARGEABLE_ROLLUP', True)
+    def test_rollup_matches_table(self):
+        paid = self.charge(3)
+        self.charge(1, failure_rate=1)
+        with patch('chargeable.models.get_gateway', return_value=SimulatedGateway(latency=0, failure_rate=0)):
+            paid[0].refund()
+
+        # extra filters make report() read the model's table
+        from_table = list(Order.objects.report(customer=self.customer))
+        self.assertEqual(list(Order.objects.report()), from_table)
+        self.assertEqual([(row['charge_status'], row['count']) for row in from_table],
+                         [(PAID, 2), (FAILED, 1), (REFUNDED, 1)])
+
+        ChargeRollup.objects.all().delete()
+        rollup.rebuild(Order)
+        self.assertEqual(list(Order.objects.report()), from_table)
+
+    def test_indexes_inherited(self):
+        expected = [['charge_status', 'charge_date'], ['charge_id'], ['charge_status', 'charge_retry_at']]
+        self.assertEqual([index.fields for index in Order._meta.indexes], expected)
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Order._meta.db_table)
+        indexed = [constraint['columns'] for constraint in constraints.values() if constraint['index']]
+        for fields in expected:
+            self.assertIn(fields, indexed)
+
+
+class TestRollup(TestCase):
+
+    def chargeable(self, status, charge_date, amount, state=None):
+        return Mock(charge_status=status, charge_date=charge_date, charge_amount=amount, _rollup_state=state,
+                    _meta=Mock(label='tests.RealChargeable'))
+
+    def test_status_change_moves_object_between_rows(self):
+        day = datetime.date(2020, 1, 1)
+        deltas = RollupDeltas()
+        deltas.add(self.chargeable(PAID, datetime.datetime(2020, 1, 1, 12), 1000))
+        deltas.add(self.chargeable(REFUNDED, datetime.datetime(2020, 1, 1, 13), 500, state=(day, PAID, 500)))
+        deltas.add(self.chargeable(VALIDATION_FAILED, None, None))
+
+        self.assertEqual(deltas.deltas, {
+            ('tests.RealChargeable', day, PAID): [0, 500],
+            ('tests.RealChargeable', day, REFUNDED): [1, 500],
+        })
+
+
+class TestAttemptLog(TestCase):
+
+    @patch('chargeable.models.ChargeAttempt.objects')
+    def test_attempts_written_in_batches(self, objects):
+        log = AttemptLog(batch_size=2, max_delay=60)
+        chargeable = Mock(pk=1, charge_status=PAID, charge_id='ch_1', _meta=Mock(label='tests.RealChargeable'))
+
+        log.add(chargeable, 'charge', 1000)
+        self.assertEqual(objects.bulk_create.call_count, 0)
+        log.add(chargeable, 'refund', 1000, duration=0.1)
+
+        self.assertEqual(objects.bulk_create.call_count, 1)
+        self.assertEqual([attempt.operation for attempt in objects.bulk_create.call_args[0][0]], ['charge', 'refund'])
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker(error_rate=0.5, min_calls=2, window=60, cooldown=60)
+        self.gateway = Mock(side_effect=APIConnectionError('timeout'))
+
+    def open_circuit(self):
+        for _ in range(2):
+            with self.assertRaises(APIConnectionError):
+                self.breaker.call(self.gateway)
+
+    def test_opens_on_errors_and_fails_fast(self):
+        self.open_circuit()
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(self.gateway)
+        self.assertEqual(self.gateway.call_count, 2)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_card_errors_do_not_open(self):
+        self.gateway.side_effect = CardError('declined', None, 'card_declined')
+        for _ in range(3):
+            with self.assertRaises(CardError):
+                self.breaker.call(self.gateway)
+
+        self.assertFalse(self.breaker.is_open())
+
+    def test_successful_probe_closes(self):
+        self.open_circuit()
+        cache.delete('chargeable_breaker_cooldown')
+        self.gateway.side_effect = None
+
+        self.breaker.call(self.gateway)
+        self.breaker.call(self.gateway)
+
+        self.assertEqual(self.gateway.call_count, 4)
+        self.assertFalse(cache.has_key('chargeable_breaker_open'))
+
+    def test_failed_probe_reopens(self):
+        self.open_circuit()
+        cache.delete('chargeable_breaker_cooldown')
+
+        with self.assertRaises(APIConnectionError):
+            self.breaker.call(self.gateway)
+
+        self.assertTrue(self.breaker.is_open())
+
+
+class TestReconcile(TestCase):
+
+    def charge(self, amount, **kwargs):
+        return dict({'amount': amount, 'amount_refunded': 0, 'status': 'succeeded',
+                     'refunded': False, 'disputed': False}, **kwargs)
+
+    def test_merge_join(self):
+        local = [
+            ('ch_1', [(1, 100, PAID)]),
+            ('ch_2', [(2, 100, PAID)]),
+            ('ch_4', [(4, 100, PAID)]),
+            ('ch_5', [(5, 100, PAID), (6, 50, REFUNDED)]),
+        ]
+        remote = [
+            ('ch_1', self.charge(100)),
+            ('ch_2', self.charge(120, refunded=True, amount_refunded=120)),
+            ('ch_3', self.charge(100)),
+            ('ch_5', self.charge(150, amount_refunded=50)),
+        ]
+
+        mismatches = [(mismatch['type'], mismatch['charge_id']) for mismatch in merge_join(local, remote)]
+
+        self.assertEqual(mismatches, [(AMOUNT_DRIFT, 'ch_2'), (STATUS_DRIFT, 'ch_2'),
+                                      (MISSING_LOCAL, 'ch_3'), (MISSING_REMOTE, 'ch_4')])
+
+    def test_failed_remote_charge_is_not_missing(self):
+        remote = [('ch_1', self.charge(100, status='failed')), ('ch_2', self.charge(100))]
+
+        self.assertEqual([mismatch['charge_id'] for mismatch in merge_join([], remote)], ['ch_2'])
+        self.assertEqual([mismatch['charge_id'] for mismatch in lookup_join([], remote)], ['ch_2'])
+
+    def test_uncaptured_charge_expects_authorized(self):
+        self.assertEqual(expected_statuses(self.charge(100, captured=False)), {AUTHORIZED})
+        self.assertEqual(expected_statuses(self.charge(100, captured=False, refunded=True)), {REFUNDED})
+
+    def test_partial_capture_is_not_drift(self):
+        # 100 authorized, 60 captured: Stripe reports the other 40 as refunded
+        charge = normalize(self.charge(100, captured=True, amount_captured=60, amount_refunded=40))
+
+        self.assertEqual(list(compare('ch_1', [(1, 60, PAID)], charge)), [])
+        self.assertEqual(expected_statuses(dict(charge, amount_refunded=50)), {PARTIALLY_REFUNDED})
+
+
+class TestReconcileModels(DatabaseTestCase):
+
+    def test_several_querysets_merged(self):
+        customer = Customer.objects.create(stripe_token='cus_1')
+        orders = [Order.objects.create(customer=customer, charge_status=PAID, charge_id=charge_id, charge_amount=100)
+                  for charge_id in ('ch_3', 'ch_1', 'ch_2')]
+        querysets = [Order.objects.filter(charge_id='ch_2'), Order.objects.exclude(charge_id='ch_2')]
+
+        local = list(local_charges(querysets))
+
+        self.assertEqual([charge_id for charge_id, _ in local], ['ch_1', 'ch_2', 'ch_3'])
+        self.assertEqual(local[0][1], [('chargeable_tests.Order:%s' % orders[1].pk, 100, PAID)])
+        self.assertEqual(list(local_charges(querysets[0])), [('ch_2', [(orders[2].pk, 100, PAID)])])
+
+        remote = [('ch_2', {'amount': 100, 'amount_refunded': 0, 'status': 'succeeded',
+                            'refunded': False, 'disputed': False})]
+        self.assertEqual(list(lookup_join(querysets, remote)), [])
+
+
+class TestAdmin(TestCase):
+
+    def test_refund_url_reversed_once(self):
+        _admin_refund_urls.clear()
+        with patch('chargeable.models.reverse', return_value='/admin/tests/realchargeable/__pk__/refund/') as reverse:
+            self.assertEqual(RealChargeable.admin_refund_url(1), '/admin/tests/realchargeable/1/refund/')
+            self.assertEqual(RealChargeable.admin_refund_url(2), '/admin/tests/realchargeable/2/refund/')
+        self.assertEqual(reverse.call_count, 1)
+        _admin_refund_urls.clear()
+
+    def test_run_job_progress(self):
+        func = Mock(side_effect=lambda batch: {'charged': batch[1:], 'failed': batch[:1]})
+
+        progress = run_job('test', func, [1, 2, 3, 4, 5], batch_size=2)
+
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(progress['done'], 5)
+        self.assertEqual(progress['outcomes'], {'charged': 2, 'failed': 3})
+        self.assertTrue(progress['finished'])
+        self.assertEqual(get_job_progress('test'), progress)
+
+    def test_run_job_error(self):
+        progress = run_job('test_error', Mock(side_effect=RuntimeError), [1])
+
+        self.assertTrue(progress['error'])
+        self.assertTrue(progress['finished'])
+
+    def test_job_lost_without_progress(self):
+        progress = new_job_progress(10, lost_after=60)
+
+        self.assertFalse(is_job_lost(progress, now=progress['updated'] + 30))
+        self.assertTrue(is_job_lost(progress, now=progress['updated'] + 90))
+        progress['finished'] = True
+        self.assertFalse(is_job_lost(progress, now=progress['updated'] + 90))
+
+
+class TestAdminActions(DatabaseTestCase):
+
+    def setUp(self):
+        self.admin = ChargeableAdmin(Order, Mock(**{'each_context.return_value': {}}))
+        self.admin.start_job = Mock()
+        customer = Customer.objects.create(stripe_token='cus_1')
+        self.paid = [Order.objects.create(customer=customer, charge_status=PAID, charge_id='ch_%s' % i,
+                                          charge_amount=1000) for i in range(2)]
+        Order.objects.create(customer=customer)
+
+    def request(self, **data):
+        request = RequestFactory().post('/', dict({'action': 'refund_selected'}, **data))
+        request.user = Mock()
+        return request
+
+    def test_refund_selected_asks_for_confirmation(self):
+        response = self.admin.refund_selected(self.request(), Order.objects.all())
+
+        self.assertEqual(response.template_name, 'admin/chargeable/job_confirmation.html')
+        self.assertEqual(response.context_data['count'], 2)
+        self.assertEqual(response.context_data['amount'], 20.0)
+        self.assertEqual(sorted(response.context_data['pks']), [order.pk for order in self.paid])
+        self.assertEqual(self.admin.start_job.call_count, 0)
+
+    def test_refund_selected_starts_job_once_confirmed(self):
+        self.assertIsNone(self.admin.refund_selected(self.request(post='yes'), Order.objects.all()))
+
+        request, queryset, func, verb = self.admin.start_job.call_args[0]
+        self.assertEqual(list(queryset.order_by('pk')), self.paid)
+        self.assertEqual(verb, 'Refunding')
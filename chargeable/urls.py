@@ -0,0 +1,7 @@
+from django.urls import path
+from chargeable.webhooks import stripe_webhook
+
+
+urlpatterns = [
+    path('stripe/webhook/', stripe_webhook, name='chargeable_stripe_webhook'),
+]
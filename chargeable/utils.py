@@ -0,0 +1,94 @@
+import threading
+from itertools import islice
+from queue import Queue, Empty
+
+from django.db import close_old_connections, connections
+from chargeable import app_settings
+
+
+def chunked(iterable, size):
+    """Yield lists of at most `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def close_connections():
+    for conn in connections.all():
+        conn.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=app_settings.CHARGEABLE_ASYNC_MAX_WORKERS)
+    return _executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    Run blocking `func` on the shared executor from the running event loop and return its result.
+    Executor threads keep their DB connections between calls, like request threads do, within CONN_MAX_AGE.
+    """
+    import asyncio
+
+    def call():
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+
+def run_concurrently(func, items, concurrency):
+    """
+    Call `func` for every item on a pool of at most `concurrency` threads.
+    Returns list of (item, result) pairs in the same order as `items`.
+    Every worker thread closes its own DB connections before exiting.
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    if concurrency <= 1 or len(items) <= 1:
+        return [(item, func(item)) for item in items]
+
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    errors = []
+
+    def worker():
+        try:
+            while not errors:
+                try:
+                    index, item = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[index] = func(item)
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            close_connections()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return list(zip(items, results))
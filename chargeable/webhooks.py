@@ -0,0 +1,206 @@
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+import stripe
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from chargeable import app_settings, rollup
+from chargeable.choices import *
+from chargeable.utils import close_connections
+
+
+logger = logging.getLogger('chargeable')
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+# Statuses an event may move an object from. Stripe does not order events, a late or replayed one
+# must never turn a refunded object back into a paid one or a paid one into a failed one.
+ALLOWED_TRANSITIONS = {
+    PAID: {NOT_PAID, AUTHORIZED, FAILED, DISPUTED, PAID},
+    FAILED: {NOT_PAID, AUTHORIZED, FAILED},
+    PARTIALLY_REFUNDED: {PAID, DISPUTED, PARTIALLY_REFUNDED},
+    REFUNDED: {AUTHORIZED, PAID, DISPUTED, PARTIALLY_REFUNDED, REFUNDED},
+    DISPUTED: {PAID, PARTIALLY_REFUNDED, REFUNDED, DISPUTED},
+}
+
+
+def get_event_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = EventBuffer()
+    return _buffer
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    if not app_settings.CHARGEABLE_WEBHOOK_SECRET:
+        raise ImproperlyConfigured('CHARGEABLE_WEBHOOK_SECRET must be set to receive Stripe webhooks')
+    try:
+        event = stripe.Webhook.construct_event(request.body,
+                                               request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+                                               app_settings.CHARGEABLE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.warning('Rejected Stripe webhook: %s', e)
+        return HttpResponseBadRequest()
+
+    # acknowledged once stored, a failure to store it lets Stripe send it again
+    get_event_buffer().add(event)
+    return HttpResponse()
+
+
+def get_status_update(event):
+    """Return (charge_id, charge_status, charge_info) the event implies or None when it changes nothing."""
+    obj = event['data']['object']
+    event_type = event['type']
+    if event_type == 'charge.refunded':
+        return obj['id'], REFUNDED if obj.get('refunded') else PARTIALLY_REFUNDED, 'Refunded in Stripe'
+    if event_type == 'charge.failed':
+        return obj['id'], FAILED, obj.get('failure_message') or 'Charge failed in Stripe'
+    if event_type == 'charge.captured':
+        return obj['id'], PAID, 'Captured in Stripe'
+    if event_type == 'charge.expired':
+        return obj['id'], FAILED, 'Authorization expired'
+    if event_type == 'charge.dispute.created':
+        return obj['charge'], DISPUTED, 'Disputed: %s' % obj.get('reason')
+    if event_type == 'charge.dispute.closed':
+        if obj.get('status') == 'won':
+            return obj['charge'], PAID, 'Dispute won'
+        return obj['charge'], DISPUTED, 'Dispute %s' % obj.get('status')
+    return None
+
+
+def apply_events(events):
+    """
+    Apply `events` to every Chargeable model with one query and one `bulk_update` per model,
+    objects whose status may not change to the event's one (see ALLOWED_TRANSITIONS) are left as they are.
+    """
+    from chargeable.models import Chargeable
+
+    updates = {}
+    for event in sorted(events, key=lambda event: event.get('created') or 0):
+        update = get_status_update(event)
+        if update is not None:
+            updates[update[0]] = (update[1], update[2][:255], event['type'])
+    if not updates:
+        return 0
+
+    updated = 0
+    for model in apps.get_models():
+        if not issubclass(model, Chargeable):
+            continue
+        objs = []
+        found = list(model._default_manager.filter(charge_id__in=list(updates)))
+        shared = Counter(obj.charge_id for obj in found)
+        for obj in found:
+            status, info, event_type = updates[obj.charge_id]
+            # Refunds of consolidated charges are done per object by refund(), the charge wide state does not apply
+            if event_type == 'charge.refunded' and shared[obj.charge_id] > 1:
+                continue
+            if obj.charge_status not in ALLOWED_TRANSITIONS[status]:
+                logger.info('Ignored %s event for %s %s with status %s', event_type, model.__name__, obj.pk,
+                            obj.charge_status)
+                continue
+            obj.charge_status = status
+            obj.charge_info = info
+            objs.append(obj)
+        if objs:
+            rollup.write(model, objs, lambda: model._default_manager.bulk_update(
+                objs, ['charge_status', 'charge_info'], batch_size=app_settings.CHARGEABLE_BULK_UPDATE_BATCH_SIZE))
+            updated += len(objs)
+    return updated
+
+
+def apply_stored(events):
+    """Apply stored `events` and mark them applied in one transaction. Returns number of updated objects."""
+    from chargeable.models import WebhookEvent
+
+    with transaction.atomic():
+        updated = apply_events(events)
+        WebhookEvent.objects.filter(event_id__in=[event['id'] for event in events]).update(applied=datetime.now())
+    return updated
+
+
+def apply_pending(batch_size=None):
+    """
+    Apply stored events that have not been applied yet, e.g. after a failed flush or a restart, oldest first.
+    Returns number of applied events.
+    """
+    from chargeable.models import WebhookEvent
+
+    batch_size = batch_size or app_settings.CHARGEABLE_WEBHOOK_BATCH_SIZE
+    pending = WebhookEvent.objects.filter(applied__isnull=True).order_by('created', 'pk')
+    applied = 0
+    while True:
+        events = [row.payload for row in pending[:batch_size]]
+        if not events:
+            return applied
+        apply_stored(events)
+        applied += len(events)
+
+
+class EventBuffer(object):
+    """
+    Stores every event as WebhookEvent, dropping events stored before (by event id),
+    and applies the rest in batches of CHARGEABLE_WEBHOOK_BATCH_SIZE or after CHARGEABLE_WEBHOOK_MAX_DELAY seconds,
+    whichever comes first. Events of a failed batch stay stored until `apply_pending()` applies them.
+    """
+
+    def __init__(self, batch_size=None, max_delay=None):
+        self.batch_size = batch_size or app_settings.CHARGEABLE_WEBHOOK_BATCH_SIZE
+        self.max_delay = app_settings.CHARGEABLE_WEBHOOK_MAX_DELAY if max_delay is None else max_delay
+        self._lock = threading.Lock()
+        self._events = []
+        self._timer = None
+
+    def add(self, event):
+        from chargeable.models import WebhookEvent
+
+        try:
+            with transaction.atomic():
+                WebhookEvent.objects.create(event_id=event['id'], event_type=event['type'], payload=event)
+        except IntegrityError:
+            logger.info('Skipped duplicate Stripe event %s', event['id'])
+            return False
+
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= self.batch_size
+            if not full and self._timer is None and self.max_delay:
+                self._timer = threading.Timer(self.max_delay, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+        if full or not self.max_delay:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not events:
+            return 0
+        try:
+            updated = apply_stored(events)
+        except Exception:
+            logger.exception('Failed to apply %s Stripe events, they stay stored until applied by apply_pending()',
+                             len(events))
+            return 0
+        logger.info('Applied %s Stripe events to %s objects', len(events), updated)
+        return updated
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            close_connections()
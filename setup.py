@@ -11,13 +11,15 @@ setup(
     license="MIT",
     keywords="django stripe charge",
     url="https://github.com/Anton-Shutik/django-chargeable.git",
-    packages=['chargeable'],
+    packages=['chargeable', 'chargeable.migrations', 'chargeable.management', 'chargeable.management.commands'],
     classifiers=[
         "Topic :: Utilities",
     ],
     install_requires=[
-        'Django>=1.0',
-        'stripe'
+        'Django>=3.2',
+        'stripe',
+        'requests',
     ],
     include_package_data=True,
+    python_requires='>=3.6',
 )